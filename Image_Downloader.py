@@ -3,12 +3,39 @@ from datetime import datetime
 from dotenv import load_dotenv
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from queue import Queue, Empty
+from queue import Queue, Empty, Full
 from flickrapi import FlickrAPI, FlickrError
 import requests
-from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed
+from collections import OrderedDict, deque
+from functools import partial
 import threading
 import json
+import io
+import tarfile
+import hashlib
+import time
+import asyncio
+import logging
+import random
+import shutil
+from email.utils import parsedate_to_datetime
+
+from metadata_db import DB_NAME, METADATA_JSON_NAME, METADATA_LOG_NAME, MetadataDB
+from storage_backends import LocalStorage, S3Storage, UploadPool
+from storage_layout import sharded_path
+from download_helpers import (FLICKR_RESULT_CAP, PHOTO_SIZES, ConcurrencyController, ResponseCache, TokenBucket,
+                              discard_part, plan_search_shards, remove_file, resume_headers, select_photo_size,
+                              start_part)
+
+try:
+    import aiohttp
+except ImportError:  # Only needed for the optional asyncio download engine.
+    aiohttp = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger("image_downloader")
 
 root = tk.Tk()
 root.title("Flickr Image Downloader")
@@ -55,47 +82,729 @@ def validate_api_keys():
 
 validate_api_keys()
 
-MAX_WORKERS = 10
+# The number of in-flight downloads is tuned at runtime by ConcurrencyController,
+# starting at INITIAL_CONCURRENCY and staying within these bounds.
+INITIAL_CONCURRENCY = 10
+MIN_CONCURRENCY = 2
+MAX_CONCURRENCY = 64  # Also the number of threaded-engine workers.
+ASYNC_MAX_IN_FLIGHT = 200  # Upper bound for the asyncio engine.
+ASYNC_DISK_WORKERS = 4  # Threads the asyncio engine writes files with.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes held in memory per in-flight download.
+
+MAX_RETRIES = 4  # Extra attempts for a download that failed with a retryable error.
+RETRY_BACKOFF_BASE = 0.5  # Seconds; doubled on every attempt.
+RETRY_BACKOFF_MAX = 30  # Upper bound for backoff and for honored Retry-After values.
+RETRYABLE_STATUSES = {408, 425, 429}  # Plus every 5xx.
+
+CONNECT_TIMEOUT = 5  # Seconds to establish a connection.
+READ_TIMEOUT = 30  # Seconds without receiving a byte before giving up.
+
+# Process-wide rate limits, adjustable from the GUI while a job runs; 0 means unlimited.
+DOWNLOAD_BYTES_PER_SECOND = 0
+DOWNLOAD_REQUESTS_PER_SECOND = 0
+API_REQUESTS_PER_SECOND = 0  # Flickr allows 3600 API calls per hour per key.
+FLICKR_MAX_PER_PAGE = 500  # Flickr ignores per_page values above this.
+SEARCH_WORKERS = 4  # Date-range shards searched concurrently.
+
+MAX_IMAGE_DIMENSION = 800  # Longest side to download; 800 matches Flickr's "_c" size.
+
+JOB_BYTE_BUDGET = 0  # Bytes one Download click may write; 0 for no limit. Editable in the UI as MB.
+MIN_FREE_BYTES = 1024 * 1024 * 1024  # Free space kept on the download folder's disk.
+ESTIMATED_BYTES_PER_PIXEL = 0.25  # Starting guess for a JPEG; each job refines it from real sizes.
+ESTIMATED_IMAGE_BYTES = 250 * 1024  # Guess for photos the search listed no dimensions for.
+DISK_SPACE_POLL_INTERVAL = 2.0  # Seconds between free-space checks while enqueueing is paused.
 
-download_queue = Queue()
+SEARCH_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.search_cache')
+SEARCH_CACHE_TTL = 24 * 60 * 60  # Seconds before a cached search response is refetched.
+SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Optional photos.getInfo lookups adding title, owner names, tags, dates and
+# description to each metadata record.
+ENRICH_METADATA = False
+ENRICH_API_CONCURRENCY = 4  # photos.getInfo calls in flight at once.
+INFO_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.info_cache')
+INFO_CACHE_TTL = 30 * 24 * 60 * 60  # Keyed by lastupdate too, so this only bounds staleness.
+INFO_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Optional owner NSID -> username/real name/profile URL resolution for attribution.
+RESOLVE_OWNER_NAMES = False
+OWNER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.owner_cache')
+OWNER_CACHE_TTL = 7 * 24 * 60 * 60
+OWNER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+OWNER_CACHE_MAX_ENTRIES = 10000  # Owners kept in memory.
+
+# Producers block once this many photos are queued, so a big job's search
+# results are paged in as the downloads keep up instead of held all at once.
+DOWNLOAD_QUEUE_SIZE = 4 * MAX_CONCURRENCY
+QUEUE_PUT_TIMEOUT = 0.5  # Seconds between checks for a cancelled job while the queue is full.
+
+download_queue = Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
 gui_queue = Queue()
 
 folder_selected = None
 
-executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+disk_executor = ThreadPoolExecutor(max_workers=ASYNC_DISK_WORKERS)
+enrich_executor = ThreadPoolExecutor(max_workers=ENRICH_API_CONCURRENCY)
+
+download_engines = ['threads', 'asyncio'] if aiohttp else ['threads']
+selected_engine = tk.StringVar(value=download_engines[0])
+hedge_requests = tk.BooleanVar(value=False)
+hedging_enabled = False  # hedge_requests as of the last Download click, for the workers.
+
+# Runs both sides of a hedged download while the worker thread waits on them.
+hedge_executor = ThreadPoolExecutor(max_workers=2 * MAX_CONCURRENCY)
+
+download_bandwidth = TokenBucket(DOWNLOAD_BYTES_PER_SECOND)
+download_requests = TokenBucket(DOWNLOAD_REQUESTS_PER_SECOND)
+api_requests = TokenBucket(API_REQUESTS_PER_SECOND)
+
+search_cache = ResponseCache(SEARCH_CACHE_DIR, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_BYTES)
+info_cache = ResponseCache(INFO_CACHE_DIR, INFO_CACHE_TTL, INFO_CACHE_MAX_BYTES)
+
+class OwnerCache:
+    """Owner NSID -> username, real name and profile URL, resolved once per OWNER_CACHE_TTL.
+
+    Lookups try an in-memory LRU, then the on-disk cache shared by every job
+    and folder, and only then people.getInfo. Concurrent lookups of the same
+    owner wait for a single API call.
+    """
+
+    def __init__(self, disk_cache, max_entries):
+        self.disk_cache = disk_cache
+        self.max_entries = max_entries
+        self._memory = OrderedDict()  # nsid -> (resolved at, owner); a disk hit keeps its time.
+        self._in_flight = {}  # nsid -> Future
+        self._lock = threading.Lock()
+
+    def resolve(self, nsid):
+        with self._lock:
+            if nsid in self._memory:
+                resolved_at, owner = self._memory[nsid]
+                if time.time() - resolved_at <= self.disk_cache.ttl:
+                    self._memory.move_to_end(nsid)
+                    return owner
+            future = self._in_flight.get(nsid)
+            if future is not None:
+                resolving = False
+            else:
+                future = self._in_flight[nsid] = Future()
+                resolving = True
+        if not resolving:
+            return future.result()
+        try:
+            resolved_at, owner = self._load(nsid)
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[nsid]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._memory[nsid] = (resolved_at, owner)
+            self._memory.move_to_end(nsid)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+            del self._in_flight[nsid]
+        future.set_result(owner)
+        return owner
+
+    def _load(self, nsid):
+        key = {'method': 'flickr.people.getInfo', 'user_id': nsid}
+        entry = self.disk_cache.get_entry(key)
+        if entry is not None:
+            return entry
+        api_requests.consume()
+        flickr = FlickrAPI(FLICKR_API_KEY, FLICKR_API_SECRET, format='parsed-json')
+        person = flickr.people.getInfo(user_id=nsid)['person']
+        owner = {
+            'username': person.get('username', {}).get('_content', ''),
+            'realname': person.get('realname', {}).get('_content', ''),
+            'profile_url': person.get('profileurl', {}).get('_content', ''),
+        }
+        self.disk_cache.put(key, owner)
+        return time.time(), owner
+
+owner_cache = OwnerCache(ResponseCache(OWNER_CACHE_DIR, OWNER_CACHE_TTL, OWNER_CACHE_MAX_BYTES),
+                         OWNER_CACHE_MAX_ENTRIES)
+
+# One keep-alive pool shared by all workers, so each image doesn't pay a fresh
+# TCP and TLS handshake to live.staticflickr.com.
+http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=2 * MAX_CONCURRENCY)  # Room for hedges.
+http_session = requests.Session()
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+
+# [requests sent, connections opened] by the asyncio engine, counted through
+# aiohttp's tracing hooks since its connector keeps no such totals.
+async_connection_counts = [0, 0]
+
+async def count_async_request(session, context, params):
+    async_connection_counts[0] += 1
+
+async def count_async_connection(session, context, params):
+    async_connection_counts[1] += 1
+
+def connection_stats():
+    """Return (requests sent, connections opened) so far by both download engines."""
+    num_requests, num_connections = async_connection_counts
+    pools = http_adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+    return num_requests, num_connections
+
+class DownloadError(Exception):
+    """A failed download attempt, classified as worth retrying or not."""
+
+    def __init__(self, message, retryable=False, retry_after=None, status=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.status = status
+
+    @classmethod
+    def from_response(cls, status, headers):
+        retryable = status in RETRYABLE_STATUSES or 500 <= status < 600
+        return cls(f"HTTP {status}", retryable, parse_retry_after(headers.get('Retry-After')), status)
+
+class HedgeLost(Exception):
+    """Raised inside the slower side of a hedged download once the other side won."""
+
+class HedgeRace:
+    """Lets exactly one side of a hedged download move its image into place."""
+
+    def __init__(self):
+        self.won = False
+        self._lock = threading.Lock()
+
+    def claim(self):
+        with self._lock:
+            if self.won:
+                return False
+            self.won = True
+            return True
+
+# Network errors that are worth another attempt, for both download engines.
+RETRYABLE_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+if aiohttp:
+    RETRYABLE_EXCEPTIONS += (aiohttp.ClientError, asyncio.TimeoutError)
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header given as seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(attempt, retry_after=None):
+    """Exponential backoff with full jitter, or the server's Retry-After if it sent one."""
+    if retry_after is not None:
+        return min(retry_after, RETRY_BACKOFF_MAX)
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+concurrency = ConcurrencyController(INITIAL_CONCURRENCY, MIN_CONCURRENCY, MAX_CONCURRENCY)
+
+FAILED_DOWNLOADS_NAME = 'failed_downloads.jsonl'  # Photos given up on and why, appended per folder.
+failed_downloads_lock = threading.Lock()
+
+class ProgressCounters:
+    """Download progress, counted per thread and only summed when the window refreshes.
+
+    Each thread increments its own slot, which no other thread writes, so
+    workers never take a lock or touch Tk per image, and the GUI tick costs
+    the same however fast downloads finish.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._slots = []
+        self._slots_lock = threading.Lock()  # Only taken the first time a thread counts.
+
+    def add(self, processed=0, failed=0, num_bytes=0):
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            slot = self._local.slot = [0, 0, 0]
+            with self._slots_lock:
+                self._slots.append(slot)
+        slot[0] += processed
+        slot[1] += failed
+        slot[2] += num_bytes
+
+    def snapshot(self):
+        """(photos processed, photos failed, bytes downloaded) so far, over all threads."""
+        with self._slots_lock:
+            slots = list(self._slots)
+        return tuple(sum(slot[i] for slot in slots) for i in range(3))
+
+progress = ProgressCounters()
+PROGRESS_REFRESH_MS = 200  # How often check_gui_queue redraws.
+PROGRESS_RATE_WINDOW = 5.0  # Seconds of history behind the shown rates and ETA.
+progress_samples = deque()  # (time, processed, bytes) at recent GUI ticks; GUI thread only.
+
+def record_failure(url, search_term, photo, error):
+    logger.warning("Giving up on photo %s (%s): %s", photo['id'], url, error)
+    progress.add(failed=1)
+    entry = {
+        "id": photo['id'],
+        "url": url,
+        "search_term": search_term,
+        "reason": str(error),
+        "failed_at": datetime.now().isoformat(timespec='seconds'),
+    }
+    try:
+        with failed_downloads_lock, open(os.path.join(folder_selected, FAILED_DOWNLOADS_NAME), 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        logger.error("Could not record the failed download of photo %s: %s", photo['id'], e)
+    if current_job is not None:
+        current_job.abandoned(photo['id'])
+
+# Put on download_queue once per worker to stop it. Everything queued before a
+# sentinel is still downloaded, so stopping an engine drains the queue first.
+STOP_WORKER = object()
+
+active_engine = None
+async_engine_thread = None
+async_engine_loop = None  # The asyncio engine's event loop while it runs...
+async_engine_closing = None  # ...and an asyncio.Event on it that close_app sets.
+app_closing = threading.Event()  # Tells search producers to stop enqueueing.
+current_job = None  # The SearchJob the progress bar is showing.
+search_jobs = []  # SearchJobs whose producers may still be running; Tk thread only.
+requested_engine = None  # The engine the last Download click asked for.
+engine_lock = threading.Lock()  # Serializes engine starts and switches between producers.
+
+DOWNLOAD_INDEX_NAME = '.downloaded.jsonl'
+
+# With content-addressed storage each distinct image is stored once, as
+# <folder>/.blobs/<2 hex>/<sha256><ext>, and every per-search file name is a
+# hardlink to its blob (or only recorded in metadata where hardlinks fail).
+CONTENT_ADDRESSED_STORAGE = False
+BLOB_DIR_NAME = '.blobs'
+
+# 'files' saves one file per image; 'tar' appends images and their metadata to
+# rolling WebDataset-style tar shards instead (STORAGE_LAYOUT and
+# CONTENT_ADDRESSED_STORAGE then don't apply).
+OUTPUT_MODE = 'files'
+TAR_SHARD_MAX_BYTES = 1024 * 1024 * 1024
+TAR_SHARD_MAX_COUNT = 10000  # Images per shard.
+
+# 'flat' puts every image straight into the folder; 'sharded' spreads them over
+# ab/cd/ subfolders (see storage_layout.py) so huge folders stay manageable.
+STORAGE_LAYOUT = 'flat'
+blob_lock = threading.Lock()
+
+# 'local' saves into the selected folder. 's3' streams images and the metadata
+# log into S3_BUCKET under S3_PREFIX/<folder name>/ instead, on AWS or any
+# S3-compatible store (set S3_ENDPOINT_URL for MinIO and the like); only the
+# download index and metadata.db stay in the local folder. OUTPUT_MODE = 'tar'
+# and CONTENT_ADDRESSED_STORAGE only apply to 'local'.
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')
+S3_BUCKET = os.getenv('S3_BUCKET', '')
+S3_PREFIX = os.getenv('S3_PREFIX', '')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL') or None
+S3_PART_SIZE = 8 * 1024 * 1024  # Multipart part size; images smaller than this take one PUT.
+S3_UPLOAD_WORKERS = 8
+S3_MAX_PENDING_PARTS = 16  # Parts buffered or uploading at once, across all downloads.
+upload_pool = UploadPool(S3_UPLOAD_WORKERS, S3_MAX_PENDING_PARTS)
 
 def set_folder():
     global folder_selected
     folder_selected = filedialog.askdirectory()
     folder_label.config(text=folder_selected)
 
-metadata_lock = threading.Lock()
+METADATA_BACKEND = 'jsonl'  # 'jsonl' for metadata.jsonl, 'sqlite' for an indexed metadata.db.
+METADATA_BATCH_SIZE = 500  # Records written per batch at most...
+METADATA_FLUSH_INTERVAL = 1.0  # ...and seconds a record may wait for its batch.
+
+class MetadataWriter:
+    """One background thread appending metadata records to each folder's metadata store.
 
-def save_metadata(search_term, photo, file_name):
-    metadata = {
+    Workers only enqueue records; the thread writes them in batches of up to
+    METADATA_BATCH_SIZE, at least every METADATA_FLUSH_INTERVAL seconds.
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self._queue = Queue()
+        self._databases = {}  # Only used from the writer thread.
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, folder, record):
+        self._queue.put((folder, record))
+
+    def call(self, fn, *args):
+        """Run fn(*args) on the writer thread and return its result.
+
+        Every record written before the call is stored first, and nothing is
+        appended while fn runs.
+        """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self._queue.put(run)
+        return future.result()
+
+    def close(self):
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        batches = {}
+        num_records = 0
+        deadline = None
+        while True:
+            timeout = max(0.0, deadline - time.monotonic()) if num_records else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = None
+            if isinstance(item, tuple):
+                folder, record = item
+                batches.setdefault(folder, []).append(record)
+                num_records += 1
+                if num_records == 1:
+                    deadline = time.monotonic() + METADATA_FLUSH_INTERVAL
+                if num_records < METADATA_BATCH_SIZE:
+                    continue
+            self._write(batches)
+            batches = {}
+            num_records = 0
+            if item is self._STOP:
+                for db in self._databases.values():
+                    db.close()
+                return
+            if callable(item):
+                item()
+
+    def _write(self, batches):
+        for folder, records in batches.items():
+            try:
+                if METADATA_BACKEND == 'sqlite':
+                    if folder not in self._databases:
+                        self._databases[folder] = MetadataDB(folder)
+                    self._databases[folder].insert_many(records)
+                else:
+                    data = ''.join(json.dumps(record) + '\n' for record in records)
+                    storage_for(folder).append(METADATA_LOG_NAME, data.encode('utf-8'))
+            except Exception as e:
+                logger.error("Could not write %d metadata records to %s: %s", len(records), folder, e)
+
+metadata_writer = MetadataWriter()
+
+class DownloadIndex:
+    """Ids of the photos already downloaded into one folder, with their sizes.
+
+    Kept as an append-only JSONL file in the folder and only read the first
+    time it is consulted, so re-running a search skips known photos without
+    any network request.
+    """
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, DOWNLOAD_INDEX_NAME)
+        self._sizes = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self._sizes = {}
+        try:
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by a crash.
+                    self._sizes[entry['id']] = entry['size']
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        with self._lock:
+            if self._sizes is None:
+                self._load()
+            return len(self._sizes)
+
+    def __contains__(self, photo_id):
+        with self._lock:
+            if self._sizes is None:
+                self._load()
+            return photo_id in self._sizes
+
+    def reserve(self, photo_id):
+        """Count photo_id as downloaded in this session without recording it yet."""
+        with self._lock:
+            if self._sizes is None:
+                self._load()
+            self._sizes.setdefault(photo_id, None)
+
+    def add(self, photo_id, size, file_name):
+        with self._lock:
+            if self._sizes is None:
+                self._load()
+            self._sizes[photo_id] = size
+            with open(self.path, 'a') as file:
+                file.write(json.dumps({'id': photo_id, 'size': size, 'name': file_name}) + '\n')
+
+storages = {}
+storages_lock = threading.Lock()
+
+def storage_for(folder):
+    """The storage backend for folder; raises RuntimeError if STORAGE_BACKEND can't be used."""
+    with storages_lock:
+        if folder not in storages:
+            if STORAGE_BACKEND == 's3':
+                prefix = f"{S3_PREFIX.strip('/')}/" if S3_PREFIX.strip('/') else ''
+                storages[folder] = S3Storage(S3_BUCKET, f"{prefix}{os.path.basename(folder)}/",
+                                             upload_pool, S3_PART_SIZE, S3_ENDPOINT_URL)
+            else:
+                storages[folder] = LocalStorage(folder)
+        return storages[folder]
+
+download_indexes = {}
+download_indexes_lock = threading.Lock()
+
+def download_index_for(folder):
+    with download_indexes_lock:
+        if folder not in download_indexes:
+            download_indexes[folder] = DownloadIndex(folder)
+        return download_indexes[folder]
+
+def build_metadata(search_term, photo, file_name, **fields):
+    return {
         "url": f"https://www.flickr.com/photos/{photo['owner']}/{photo['id']}",
         "name": file_name,
         "creator": photo.get('owner', ''),
         "license": photo.get('license', ''),
+        "id": photo['id'],
+        "search_term": search_term,
+        "downloaded_at": datetime.now().isoformat(timespec='seconds'),
+        **fields,
+    }
+
+class TarShardWriter:
+    """Appends images and their metadata records to rolling tar shards in one folder.
+
+    Each sample is <photo id><ext> plus <photo id>.json, as WebDataset expects.
+    The open shard is written as shard-NNNNNN.tar.part; once it holds
+    TAR_SHARD_MAX_COUNT samples or TAR_SHARD_MAX_BYTES it is closed, fsynced
+    and renamed to shard-NNNNNN.tar, so readers only ever see complete shards.
+    Each sample's on_finalized callback only runs after that rename is
+    durable, so nothing records a photo that a crash could still lose. A
+    shard that isn't full yet is finished by close() once a job's downloads
+    drain; the next add() then starts a new one.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._tar = None
+        self._file = None
+        self._count = 0
+        self._on_finalized = []
+        self._lock = threading.Lock()
+        for name in os.listdir(folder):
+            if name.startswith('shard-') and name.endswith('.tar.part'):
+                # Its photos were never indexed, so they are downloaded again.
+                logger.warning("Discarding incomplete tar shard from an earlier run: %s", name)
+                remove_file(os.path.join(folder, name))
+        numbers = [int(name[6:12]) for name in os.listdir(folder)
+                   if name.startswith('shard-') and name[6:12].isdigit()]
+        self._number = max(numbers) + 1 if numbers else 0
+
+    @property
+    def shard_name(self):
+        return f"shard-{self._number:06d}.tar"
+
+    def add(self, key, image_path, extension, record, on_finalized):
+        """Append one sample; on_finalized(shard name) is called once its shard is complete."""
+        data = json.dumps(record).encode('utf-8')
+        with self._lock:
+            if self._tar is None:
+                self._file = open(os.path.join(self.folder, f"{self.shard_name}.part"), 'wb')
+                self._tar = tarfile.open(fileobj=self._file, mode='w')
+            self._tar.add(image_path, arcname=f"{key}{extension}")
+            info = tarfile.TarInfo(f"{key}.json")
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, io.BytesIO(data))
+            self._count += 1
+            self._on_finalized.append(on_finalized)
+            if self._count >= TAR_SHARD_MAX_COUNT or self._file.tell() >= TAR_SHARD_MAX_BYTES:
+                self._finish_shard()
+
+    def close(self):
+        with self._lock:
+            if self._tar is not None:
+                self._finish_shard()
+
+    def _finish_shard(self):
+        self._tar.close()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        path = os.path.join(self.folder, self.shard_name)
+        os.replace(f"{path}.part", path)
+        fsync_directory(self.folder)
+        for on_finalized in self._on_finalized:
+            on_finalized(self.shard_name)
+        self._tar = self._file = None
+        self._count = 0
+        self._on_finalized = []
+        self._number += 1
+
+def fsync_directory(path):
+    """Make a rename inside path durable; Windows can't open directories and needs no fsync."""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+tar_writers = {}
+tar_writers_lock = threading.Lock()
+
+def tar_writer_for(folder):
+    with tar_writers_lock:
+        if folder not in tar_writers:
+            tar_writers[folder] = TarShardWriter(folder)
+        return tar_writers[folder]
+
+def finish_tar_shards():
+    """Finish every open tar shard, recording the photos in it."""
+    with tar_writers_lock:
+        writers = list(tar_writers.values())
+    for writer in writers:
+        writer.close()
+
+def save_metadata(search_term, photo, file_name, **fields):
+    write_metadata(folder_selected, build_metadata(search_term, photo, file_name, **fields), photo)
+
+def write_metadata(folder, metadata, photo):
+    if ENRICH_METADATA or RESOLVE_OWNER_NAMES:
+        enrich_executor.submit(enrich_metadata, folder, metadata, photo)
+    else:
+        metadata_writer.write(folder, metadata)
+
+def fetch_photo_info(photo):
+    """photos.getInfo for photo, cached on disk until the photo's lastupdate changes."""
+    key = {
+        'method': 'flickr.photos.getInfo',
+        'photo_id': photo['id'],
+        'lastupdate': str(photo.get('lastupdate', '')),
     }
+    info = info_cache.get(key)
+    if info is None:
+        api_requests.consume()
+        flickr = FlickrAPI(FLICKR_API_KEY, FLICKR_API_SECRET, format='parsed-json')
+        info = flickr.photos.getInfo(photo_id=photo['id'], secret=photo.get('secret'))['photo']
+        info_cache.put(key, info)
+    return info
+
+def enrich_metadata(folder, metadata, photo):
+    """Add photos.getInfo details and/or the owner's names to a metadata record,
+    then hand it to metadata_writer.
 
-    metadata_path = os.path.join(folder_selected, "metadata.json")
-    
-    with metadata_lock:
-        if os.path.exists(metadata_path):
-            with open(metadata_path, 'r') as file:
-                existing_data = json.load(file)
-            existing_data.append(metadata)
-            with open(metadata_path, 'w') as file:
-                json.dump(existing_data, file, indent=4)
+    Runs on enrich_executor, which bounds the number of concurrent API calls.
+    A failed lookup still writes the record, just without those fields.
+    """
+    if ENRICH_METADATA:
+        try:
+            info = fetch_photo_info(photo)
+        except Exception as e:
+            logger.warning("Could not fetch info for photo %s: %s", photo['id'], e)
+        else:
+            owner = info.get('owner', {})
+            dates = info.get('dates', {})
+            metadata.update({
+                "title": info.get('title', {}).get('_content', ''),
+                "description": info.get('description', {}).get('_content', ''),
+                "owner_username": owner.get('username', ''),
+                "owner_realname": owner.get('realname', ''),
+                "tags": [tag['raw'] for tag in info.get('tags', {}).get('tag', [])],
+                "date_taken": dates.get('taken', ''),
+                "date_posted": datetime.fromtimestamp(int(dates['posted'])).isoformat() if dates.get('posted') else '',
+            })
+    if RESOLVE_OWNER_NAMES and photo.get('owner'):
+        try:
+            owner = owner_cache.resolve(photo['owner'])
+        except Exception as e:
+            logger.warning("Could not resolve owner %s: %s", photo['owner'], e)
         else:
-            with open(metadata_path, 'w') as file:
-                json.dump([metadata], file, indent=4)
+            metadata.update({
+                "creator_username": owner['username'],
+                "creator_realname": owner['realname'],
+                "creator_profile_url": owner['profile_url'],
+            })
+    metadata_writer.write(folder, metadata)
+
+def read_metadata(folder):
+    """Every metadata record for folder: metadata.json, then metadata.jsonl and metadata.db.
+
+    Records still queued in metadata_writer are not included; run this on its
+    thread (see MetadataWriter.call) to see everything written before.
+    """
+    storage = storage_for(folder)
+    records = []
+    data = storage.read(METADATA_JSON_NAME)
+    if data is not None:
+        records.extend(json.loads(data))
+    for line in storage.read_appended(METADATA_LOG_NAME).decode('utf-8').splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue  # A line cut short by a crash.
+    if os.path.exists(os.path.join(folder, DB_NAME)):
+        db = MetadataDB(folder)
+        try:
+            records.extend(db.query())
+        finally:
+            db.close()
+    return records
+
+def export_metadata_json(folder):
+    """Compact metadata.jsonl into the legacy metadata.json array and empty the log.
+
+    Safe to repeat after a crash between the two steps: records are keyed by
+    file name, so a record already exported is not duplicated. Runs on the
+    metadata writer's thread, so no batch can be appended between reading the
+    log and emptying it.
+    """
+    return metadata_writer.call(compact_metadata, folder)
+
+def compact_metadata(folder):
+    records = {}
+    for record in read_metadata(folder):
+        records[record["name"]] = record
+    storage = storage_for(folder)
+    storage.put(METADATA_JSON_NAME, json.dumps(list(records.values()), indent=4).encode('utf-8'))
+    storage.clear_appended(METADATA_LOG_NAME)
+    return len(records)
 
 
 def download_images_from_flickr():
+    global current_job, hedging_enabled, requested_engine
     search_term = search_entry.get()
     num_of_images = int(images_entry.get())
+    try:
+        byte_budget = int(float(budget_entry.get() or 0) * 1024 * 1024)
+    except ValueError:
+        messagebox.showwarning("Invalid Budget", "The byte budget must be a number of MB (0 for unlimited).")
+        return
 
     if not folder_selected:
         messagebox.showwarning("Folder Not Selected", "Please select a folder to save the images.")
@@ -109,76 +818,885 @@ def download_images_from_flickr():
         messagebox.showwarning("Number of Images Not Provided", "Please provide the number of images to download.")
         return
 
+    try:
+        storage_for(folder_selected)
+    except RuntimeError as e:
+        messagebox.showerror("Storage Unavailable", str(e))
+        return
+
+    engine = selected_engine.get()
+    if requested_engine not in (None, engine) and download_queue.unfinished_tasks:
+        messagebox.showwarning("Downloads In Progress",
+                               "The download engine can be changed once the current downloads finish.")
+        return
+
     # Reset progress bar
     progress_bar['value'] = 0
     countdown_label.config(text="Images Remaining: 0")
 
     flickr = FlickrAPI(FLICKR_API_KEY, FLICKR_API_SECRET, format='parsed-json')
 
-    photos = flickr.photos.search(
-        text=search_term, per_page=num_of_images, page=1, sort='relevance',
+    search_kwargs = dict(
+        text=search_term, sort='relevance',
         license=selected_license.get(),  # Get the selected license from the dropdown menu
 
-        content_type=1  # Only photos
+        content_type=1,  # Only photos
+        # last_update keys the photos.getInfo cache used by enrich_metadata.
+        extras=','.join([f"url_{size}" for size in PHOTO_SIZES] + ['last_update']),
     )
 
-    if photos and photos['photos']['photo']:
-        photos_list = photos['photos']['photo']
+    # Producers of earlier clicks still paging would enqueue photos after the
+    # old engine's stop sentinels, where no worker is left to take them.
+    previous_jobs = [job for job in search_jobs if not job.producer_done.is_set()]
+    if engine != requested_engine:
+        for job in previous_jobs:
+            job.cancelled.set()
+    requested_engine = engine
 
-        for photo in photos_list:
-            url = f"https://live.staticflickr.com/{photo['server']}/{photo['id']}_{photo['secret']}_c.jpg"
-            download_queue.put((url, search_term, photo))
+    job = current_job = SearchJob(search_term, num_of_images, download_index_for(folder_selected), byte_budget)
+    search_jobs[:] = previous_jobs + [job]
+    hedging_enabled = hedge_requests.get()
 
-        countdown_label.config(
-            text=f"Images Remaining: {download_queue.qsize()}")
+    countdown_label.config(text="Searching...")
 
-        # Reset progress bar maximum value
-        progress_bar['maximum'] = download_queue.qsize()
+    # Reset progress bar maximum value
+    progress_bar['maximum'] = num_of_images
 
-        for i in range(MAX_WORKERS):
-            executor.submit(download_image)
+    # Searching blocks on the network for seconds to minutes, and switching
+    # engines waits for the old one to drain, so both run on their own thread,
+    # which reports back through gui_queue.
+    threading.Thread(target=run_search_job, args=(flickr, job, search_kwargs, engine, previous_jobs),
+                     daemon=True).start()
+
+class SearchJob:
+    """Enqueue budget shared by all shard producers of one Download click.
+
+    Besides the image count it tracks bytes: every enqueued photo is projected
+    from its listed dimensions (then from its Content-Length once the response
+    arrives) until it finishes and its actual size is known. byte_budget caps
+    the projection; bytes per pixel is learned from the photos finished so far.
+    """
+
+    def __init__(self, search_term, num_of_images, index, byte_budget=0):
+        self.search_term = search_term
+        self.num_of_images = num_of_images
+        self.index = index
+        self.byte_budget = byte_budget
+        self.enqueued = 0
+        self.skipped = 0  # Photos already in the folder from an earlier run.
+        self.actual_bytes = 0
+        self.stop_reason = None  # Why enqueueing stopped early, for the status line.
+        self.paused = False  # Enqueueing is waiting for free disk space.
+        self.progress_start = progress.snapshot()
+        self.connections_start = connection_stats()
+        self.producer_done = threading.Event()
+        self.drained = threading.Event()  # Producer done and every queued photo stored.
+        self.cancelled = threading.Event()  # Stops the producers without a reason to show.
+        self._seen_ids = set()
+        self._pending = {}  # Photo id -> [projected bytes, pixels, from Content-Length] until done.
+        self._pending_total = 0  # Sum of the projected bytes in _pending...
+        self._known_total = 0  # ...and of those that came from a Content-Length.
+        self._num_finished = 0
+        self._pixels_done = 0
+        self._pixel_bytes_done = 0
+        self._lock = threading.Lock()
+
+    @property
+    def full(self):
+        return self.enqueued >= self.num_of_images or self.stop_reason is not None or self.cancelled.is_set()
+
+    @property
+    def pending_bytes(self):
+        return self._pending_total
+
+    @property
+    def projected_bytes(self):
+        """Bytes this job is expected to write in all: finished plus pending."""
+        with self._lock:
+            return self.actual_bytes + self._pending_total
+
+    def predict_bytes(self, width, height):
+        with self._lock:
+            if not width or not height:
+                return self.actual_bytes // self._num_finished if self._num_finished else ESTIMATED_IMAGE_BYTES
+            if self._pixels_done:
+                return int(width * height * self._pixel_bytes_done / self._pixels_done)
+            return int(width * height * ESTIMATED_BYTES_PER_PIXEL)
+
+    def claim(self, photo, width=0, height=0):
+        """Reserve a slot for photo; False if the job is full, over its byte budget,
+        the photo is a duplicate or already downloaded."""
+        projected = self.predict_bytes(width, height)
+        with self._lock:
+            if self.full or photo['id'] in self._seen_ids:
+                return False
+            self._seen_ids.add(photo['id'])
+            if photo['id'] in self.index:
+                self.skipped += 1
+                return False
+            if self.byte_budget and self.actual_bytes + self._pending_total + projected > self.byte_budget:
+                self.stop_reason = "Stopped at the byte budget."
+                return False
+            self.enqueued += 1
+            self._pending[photo['id']] = [projected, width * height, False]
+            self._pending_total += projected
+            return True
+
+    def expect(self, photo_id, num_bytes):
+        """Replace a photo's projection with its Content-Length.
+
+        Returns False if the finished photos plus those known sizes break the
+        byte budget; photos still queued only have estimates and don't count.
+        """
+        with self._lock:
+            pending = self._pending.get(photo_id)
+            if pending is None:
+                return True
+            self._pending_total += num_bytes - pending[0]
+            if pending[2]:
+                self._known_total -= pending[0]  # A retry got the size again.
+            self._known_total += num_bytes
+            pending[0] = num_bytes
+            pending[2] = True
+            return not self.byte_budget or self.actual_bytes + self._known_total <= self.byte_budget
+
+    def finished(self, photo_id, num_bytes):
+        with self._lock:
+            if photo_id not in self._pending:
+                return  # Queued by an earlier job.
+            pixels = self._forget(photo_id)
+            self.actual_bytes += num_bytes
+            self._num_finished += 1
+            if pixels:
+                self._pixels_done += pixels
+                self._pixel_bytes_done += num_bytes
+
+    def abandoned(self, photo_id):
+        with self._lock:
+            if photo_id in self._pending:
+                self._forget(photo_id)
+
+    def _forget(self, photo_id):
+        """Drop a pending photo from the running totals and return its pixel count."""
+        projected, pixels, known = self._pending.pop(photo_id)
+        self._pending_total -= projected
+        if known:
+            self._known_total -= projected
+        return pixels
+
+    def stop(self, reason):
+        with self._lock:
+            if self.stop_reason is None:
+                self.stop_reason = reason
+
+def free_disk_bytes():
+    return shutil.disk_usage(folder_selected).free
+
+def wait_for_disk_space(job, num_bytes):
+    """Block enqueueing until num_bytes more fit above MIN_FREE_BYTES.
+
+    Space already promised to pending downloads counts as used. Waits while
+    downloads are still pending, since they may turn out smaller than
+    projected or the user may free some space; stops the job once nothing is
+    pending and the space still isn't there. Returns whether to go on.
+    """
+    if not storage_for(folder_selected).uses_local_disk:
+        return True
+    while not app_closing.is_set() and not job.full:
+        pending_bytes = job.pending_bytes
+        if free_disk_bytes() - pending_bytes - num_bytes >= MIN_FREE_BYTES:
+            job.paused = False
+            return True
+        if not pending_bytes:
+            job.stop(f"Stopped: less than {format_bytes(MIN_FREE_BYTES)} would be left free on disk.")
+            break
+        job.paused = True
+        app_closing.wait(DISK_SPACE_POLL_INTERVAL)
+    job.paused = False
+    return False
+
+def check_disk_space(photo, total, offset):
+    """Refine the job's projection with a response's size and refuse it if it
+    breaks the byte budget or would leave less than MIN_FREE_BYTES free."""
+    job = current_job
+    if total is None:
+        return
+    if job is not None and not job.expect(photo['id'], total):
+        job.stop("Stopped at the byte budget.")
+        raise DownloadError("Over the job's byte budget")
+    if storage_for(folder_selected).uses_local_disk and free_disk_bytes() - (total - offset) < MIN_FREE_BYTES:
+        if job is not None:
+            job.stop(f"Stopped: less than {format_bytes(MIN_FREE_BYTES)} would be left free on disk.")
+        raise DownloadError("Not enough free disk space")
+
+def format_bytes(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == 'B' else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+def search_photos(flickr, **search_kwargs):
+    """flickr.photos.search, answered from search_cache when possible."""
+    key = {name: str(value) for name, value in search_kwargs.items()}
+    key['method'] = 'flickr.photos.search'
+    photos = search_cache.get(key)
+    if photos is None:
+        api_requests.consume()
+        photos = flickr.photos.search(**search_kwargs)
+        search_cache.put(key, photos)
+    return photos
+
+def count_search_results(flickr, **search_kwargs):
+    photos = search_photos(flickr, per_page=1, page=1, **search_kwargs)['photos']
+    return int(photos['total'])
+
+def iter_search_photos(flickr, num_of_images, per_page=None, **search_kwargs):
+    """Yield up to num_of_images search results, fetching one page at a time."""
+    per_page = min(per_page or num_of_images, FLICKR_MAX_PER_PAGE)
+    yielded = 0
+    page = 1
+    while yielded < num_of_images:
+        photos = search_photos(flickr, per_page=per_page, page=page, **search_kwargs)['photos']
+        for photo in photos['photo']:
+            yield photo
+            yielded += 1
+            if yielded >= num_of_images:
+                return
+        if not photos['photo'] or page >= int(photos['pages']):
+            return
+        page += 1
+
+def enqueue_shard(flickr, job, shard, per_page):
+    # Page through the whole shard if need be, since photos from earlier runs
+    # are skipped without counting towards the job.
+    for photo in iter_search_photos(flickr, FLICKR_RESULT_CAP, per_page=per_page, **shard):
+        if job.full or app_closing.is_set():
+            return
+        size = select_photo_size(photo, MAX_IMAGE_DIMENSION)
+        if size is None:
+            continue
+        url, width, height = size
+        # Photos claim skips as already downloaded need no disk space.
+        if photo['id'] not in job.index and not wait_for_disk_space(job, job.predict_bytes(width, height)):
+            return
+        if job.claim(photo, width, height):
+            if not enqueue_download(job, (url, job.search_term, photo)):
+                job.abandoned(photo['id'])
+                return
+            if job.full:
+                return  # Without fetching another page first.
+
+def enqueue_download(job, item):
+    """Put item on download_queue once there is room; False if job was cancelled first."""
+    while not job.cancelled.is_set() and not app_closing.is_set():
+        try:
+            download_queue.put(item, timeout=QUEUE_PUT_TIMEOUT)
+            return True
+        except Full:
+            continue
+    return False
 
+def run_search_job(flickr, job, search_kwargs, engine, previous_jobs):
+    """Producer stage of a Download click: start engine, plan the search and enqueue its photos.
+
+    Runs on a background thread and only talks to the window through
+    ("status", job, text) and ("search_ended", job, message) events on gui_queue.
+    """
+    try:
+        if engine != active_engine:
+            # The click cancelled previous_jobs; once their producers are gone
+            # nothing else can enqueue while the old engine drains.
+            for previous_job in previous_jobs:
+                previous_job.producer_done.wait()
+        with engine_lock:
+            if job.cancelled.is_set() or app_closing.is_set():
+                return
+            start_download_engine(engine)
+        # Photos from earlier runs are skipped, so plan for enough results to
+        # get past them too; otherwise re-runs of a popular term would only
+        # ever see its first FLICKR_RESULT_CAP results.
+        num_indexed = len(job.index)
+        shards = plan_search_shards(partial(count_search_results, flickr), job.num_of_images + num_indexed,
+                                    search_kwargs)
+        if not shards:
+            job.stop("No images found for the provided search term.")
+            gui_queue.put(("search_ended", job, job.stop_reason))
+            return
+        gui_queue.put(("status", job, f"Images Remaining: {job.num_of_images}"))
+        with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as search_executor:
+            # Full pages when many results may be skipped, so skipping costs few API calls.
+            per_page = FLICKR_MAX_PER_PAGE if num_indexed else job.num_of_images
+            futures = [search_executor.submit(enqueue_shard, flickr, job, shard, per_page) for shard in shards]
+            for future in as_completed(futures):
+                future.result()
+    except Exception as e:
+        logger.error("Search for %r failed: %s", job.search_term, e)
+        job.stop(f"Search failed: {e}")
+        gui_queue.put(("search_ended", job, job.stop_reason))
+    finally:
+        job.producer_done.set()
+        # Finish the last tar shard now rather than at exit, so the photos in
+        # it are readable and recorded as soon as the job is done.
+        download_queue.join()
+        try:
+            finish_tar_shards()
+        except OSError as e:
+            logger.error("Could not finish tar shard: %s", e)
+        job.drained.set()
+
+def start_download_engine(engine):
+    """Start long-lived workers for engine unless they are already running.
+
+    Workers of the previously active engine are stopped first, which waits for
+    download_queue to drain, so this never runs on the Tk thread.
+    """
+    global active_engine, async_engine_thread, concurrency
+    if engine == active_engine:
+        return
+    stop_download_engine()
+    if engine == 'asyncio':
+        concurrency = ConcurrencyController(INITIAL_CONCURRENCY, MIN_CONCURRENCY, ASYNC_MAX_IN_FLIGHT)
+        async_engine_thread = threading.Thread(target=asyncio.run, args=(download_images_async(),), daemon=True)
+        async_engine_thread.start()
     else:
-        messagebox.showinfo("No Images Found", "No images found for the provided search term.")
+        concurrency = ConcurrencyController(INITIAL_CONCURRENCY, MIN_CONCURRENCY, MAX_CONCURRENCY)
+        for i in range(MAX_CONCURRENCY):
+            executor.submit(download_image)
+    active_engine = engine
 
-def download_image():
-    while not download_queue.empty():
+def stop_download_engine(wait=True):
+    """Send one STOP_WORKER per worker of the active engine and optionally wait for them."""
+    global active_engine
+    if active_engine is None:
+        return
+    num_workers = 1 if active_engine == 'asyncio' else MAX_CONCURRENCY
+    for i in range(num_workers):
+        download_queue.put(STOP_WORKER)
+    if wait:
+        download_queue.join()
+    active_engine = None
+
+def discard_queued_downloads():
+    """Drop every photo still waiting in download_queue."""
+    while True:
         try:
-            url, search_term, photo = download_queue.get_nowait()
+            download_queue.get_nowait()
         except Empty:
-            break
-        else:
-            response = requests.get(url)
-            if response.status_code == 200:
-                file_name = create_file_name(search_term, photo)
-                save_image(response.content, file_name)
-                save_metadata(search_term, photo, file_name)
-            gui_queue.put(None)
+            return
+        download_queue.task_done()
+
+def close_app():
+    # Queued photos are dropped; in-flight ones finish (or keep their .part file)
+    # while the workers shut down after the window is gone. The stop sentinels
+    # are only queued then too, since a producer that was already waiting for
+    # room in the bounded queue may still get one more photo in, and putting
+    # them must not block the window.
+    app_closing.set()
+    if async_engine_loop is not None:
+        try:
+            async_engine_loop.call_soon_threadsafe(async_engine_closing.set)
+        except RuntimeError:
+            pass  # The engine stopped in the meantime.
+    for job in search_jobs:
+        job.cancelled.set()
+    discard_queued_downloads()
+    root.destroy()
+
+def download_image():
+    """Threaded-engine worker: download queued photos until a STOP_WORKER arrives."""
+    while True:
+        item = download_queue.get()
+        if item is STOP_WORKER:
+            download_queue.task_done()
+            return
+        url, search_term, photo = item
+        try:
+            download_with_retries(url, search_term, photo)
+        finally:
+            progress.add(processed=1)
             download_queue.task_done()
 
-def create_file_name(search_term, photo):
+def download_with_retries(url, search_term, photo):
+    for attempt in range(MAX_RETRIES + 1):
+        controller = concurrency
+        controller.acquire()
+        started = time.monotonic()
+        num_bytes = 0
+        error = None
+        try:
+            if hedging_enabled:
+                num_bytes = fetch_hedged(url, search_term, photo, controller.hedge_delay())
+            else:
+                num_bytes = fetch_image(url, search_term, photo)
+        except DownloadError as e:
+            error = e
+        except RETRYABLE_EXCEPTIONS as e:
+            error = DownloadError(repr(e), retryable=True)
+        except Exception as e:
+            error = DownloadError(repr(e))
+        finally:
+            controller.release(time.monotonic() - started, num_bytes, error)
+        if error is None:
+            progress.add(num_bytes=num_bytes)
+            return True
+        # Once the app is closing nobody waits for a retry, least of all
+        # for its backoff, which would keep the process alive.
+        if not error.retryable or attempt == MAX_RETRIES or app_closing.is_set():
+            break
+        if app_closing.wait(retry_delay(attempt, error.retry_after)):
+            break
+    record_failure(url, search_term, photo, error)
+    return False
+
+async def download_with_retries_async(session, url, search_term, photo):
+    for attempt in range(MAX_RETRIES + 1):
+        controller = concurrency
+        await controller.acquire_async()
+        started = time.monotonic()
+        num_bytes = 0
+        error = None
+        try:
+            if hedging_enabled:
+                num_bytes = await fetch_hedged_async(session, url, search_term, photo, controller.hedge_delay())
+            else:
+                num_bytes = await fetch_image_async(session, url, search_term, photo)
+        except DownloadError as e:
+            error = e
+        except RETRYABLE_EXCEPTIONS as e:
+            error = DownloadError(repr(e), retryable=True)
+        except Exception as e:
+            error = DownloadError(repr(e))
+        finally:
+            controller.release(time.monotonic() - started, num_bytes, error)
+        if error is None:
+            progress.add(num_bytes=num_bytes)
+            return True
+        if not error.retryable or attempt == MAX_RETRIES or app_closing.is_set():
+            break
+        if await wait_for_retry(retry_delay(attempt, error.retry_after)):
+            break
+    record_failure(url, search_term, photo, error)
+    return False
+
+async def wait_for_retry(delay):
+    """Sleep delay seconds before a retry; True if the app started closing meanwhile."""
+    try:
+        await asyncio.wait_for(async_engine_closing.wait(), delay)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+async def download_images_async():
+    """Drain download_queue from a single event loop instead of worker threads.
+
+    Up to ASYNC_MAX_IN_FLIGHT downloads run at once; finished images are
+    written to disk on disk_executor so file I/O never blocks the loop. Runs
+    until it takes a STOP_WORKER off the queue, then lets in-flight downloads
+    finish.
+    """
+    global async_engine_loop, async_engine_closing
+    loop = asyncio.get_running_loop()
+    async_engine_closing = asyncio.Event()
+    async_engine_loop = loop
+    if app_closing.is_set():  # Before close_app could see the loop.
+        async_engine_closing.set()
+    semaphore = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+    tasks = set()
+    connector = aiohttp.TCPConnector(limit=ASYNC_MAX_IN_FLIGHT)
+    timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(count_async_request)
+    trace_config.on_connection_create_end.append(count_async_connection)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace_config]) as session:
+        while True:
+            await semaphore.acquire()
+            item = await loop.run_in_executor(None, download_queue.get)
+            if item is STOP_WORKER:
+                download_queue.task_done()
+                break
+            url, search_term, photo = item
+            task = asyncio.create_task(download_image_async(session, semaphore, url, search_term, photo))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    async_engine_loop = None
+
+async def download_image_async(session, semaphore, url, search_term, photo):
+    try:
+        await download_with_retries_async(session, url, search_term, photo)
+    finally:
+        semaphore.release()
+        progress.add(processed=1)
+        download_queue.task_done()
+
+def fetch_image(url, search_term, photo, part_path=None, race=None):
+    """Download one photo into an upload of its storage backend and commit it when complete.
+
+    Returns the number of bytes transferred; raises DownloadError when the
+    attempt failed. On local storage an incomplete .part file is kept so the
+    next attempt can resume it with a Range request. part_path and race are
+    set by fetch_hedged.
+    """
+    storage = storage_for(folder_selected)
+    file_name, key = image_key(search_term, photo, url)
+    part_path = (part_path or part_path_for(search_term, photo, url)) if storage.uses_local_disk else None
+    offset, headers = resume_headers(part_path, url)
+    download_requests.consume()
+    upload = None
+    try:
+        with http_session.get(url, headers=headers, stream=True,
+                              timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+            part = start_part(part_path, url, offset, response.status_code, response.headers)
+            if part is None:
+                raise part_error(response.status_code, response.headers)
+            mode, total = part
+            if mode:
+                check_disk_space(photo, total, offset)
+            upload, hasher = open_image_upload(storage, key, part_path, mode)
+            num_bytes = 0
+            if mode:
+                num_bytes = save_image(response.iter_content(DOWNLOAD_CHUNK_SIZE), upload, hasher, race)
+        if race is not None and not race.claim():
+            raise HedgeLost()
+    except BaseException as e:
+        if upload is not None:
+            upload.abort()
+        if isinstance(e, HedgeLost) and part_path is not None:
+            discard_part(part_path)
+        raise
+    size = num_bytes + (offset if mode != 'wb' else 0)
+    if not complete_download(upload, size, total, file_name, key, search_term, photo, hasher.hexdigest()):
+        raise DownloadError("Incomplete response body", retryable=True)
+    return num_bytes
+
+def fetch_hedged(url, search_term, photo, delay):
+    """fetch_image, raced by a duplicate request if it outlives delay (the running p95).
+
+    Whichever side finishes first is kept and the other one is abandoned, and
+    its part file removed however it ends. A download that would resume a
+    .part file is never hedged.
+    """
+    part_path = part_path_for(search_term, photo, url)
+    if delay is None or os.path.exists(part_path):
+        return fetch_image(url, search_term, photo)
+    race = HedgeRace()
+    primary = hedge_executor.submit(fetch_image, url, search_term, photo, part_path, race)
+    if wait([primary], timeout=delay).done:
+        return primary.result()
+    hedge_part_path = f"{part_path}.hedge"
+    hedge = hedge_executor.submit(fetch_image, url, search_term, photo, hedge_part_path, race)
+    error = None
+    for future in as_completed([primary, hedge]):
+        try:
+            result = future.result()
+        except HedgeLost:
+            continue
+        except Exception as e:
+            error = e
+            continue
+        # The loser typically ends in a read timeout rather than HedgeLost, or
+        # already failed; either way its part file will never be resumed.
+        loser, loser_part_path = (hedge, hedge_part_path) if future is primary else (primary, part_path)
+        loser.add_done_callback(lambda _: discard_part(loser_part_path))
+        return result
+    discard_part(hedge_part_path)  # Only the primary's .part file is ever resumed.
+    raise error
+
+async def fetch_image_async(session, url, search_term, photo, part_path=None, race=None):
+    """fetch_image for the asyncio engine; every disk and upload call runs on disk_executor."""
+    loop = asyncio.get_running_loop()
+    storage = storage_for(folder_selected)
+    file_name, key = image_key(search_term, photo, url)
+    part_path = (part_path or part_path_for(search_term, photo, url)) if storage.uses_local_disk else None
+    offset, headers = await loop.run_in_executor(disk_executor, resume_headers, part_path, url)
+    await download_requests.consume_async()
+    upload = None
+    try:
+        async with session.get(url, headers=headers) as response:
+            part = await loop.run_in_executor(
+                disk_executor, start_part, part_path, url, offset, response.status, response.headers)
+            if part is None:
+                raise part_error(response.status, response.headers)
+            mode, total = part
+            if mode:
+                await loop.run_in_executor(disk_executor, check_disk_space, photo, total, offset)
+            upload, hasher = await loop.run_in_executor(
+                disk_executor, open_image_upload, storage, key, part_path, mode)
+            num_bytes = 0
+            if mode:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    if race is not None and race.won:
+                        raise HedgeLost()
+                    await download_bandwidth.consume_async(len(chunk))
+                    await loop.run_in_executor(disk_executor, write_chunk, upload, hasher, chunk)
+                    num_bytes += len(chunk)
+        if race is not None and not race.claim():
+            raise HedgeLost()
+    except BaseException as e:
+        if upload is not None:
+            await loop.run_in_executor(disk_executor, upload.abort)
+        if isinstance(e, (HedgeLost, asyncio.CancelledError)) and race is not None and part_path is not None:
+            await loop.run_in_executor(disk_executor, discard_part, part_path)
+        raise
+    size = num_bytes + (offset if mode != 'wb' else 0)
+    if not await loop.run_in_executor(disk_executor, complete_download, upload, size, total, file_name, key,
+                                      search_term, photo, hasher.hexdigest()):
+        raise DownloadError("Incomplete response body", retryable=True)
+    return num_bytes
+
+async def fetch_hedged_async(session, url, search_term, photo, delay):
+    """fetch_hedged for the asyncio engine; the losing request is cancelled outright."""
+    part_path = part_path_for(search_term, photo, url)
+    if delay is None or os.path.exists(part_path):
+        return await fetch_image_async(session, url, search_term, photo)
+    loop = asyncio.get_running_loop()
+    race = HedgeRace()
+    part_paths = {asyncio.create_task(fetch_image_async(session, url, search_term, photo, part_path, race)): part_path}
+    done, pending = await asyncio.wait(part_paths, timeout=delay)
+    if not done:
+        hedge = asyncio.create_task(fetch_image_async(session, url, search_term, photo, f"{part_path}.hedge", race))
+        part_paths[hedge] = f"{part_path}.hedge"
+        pending.add(hedge)
+    error = None
+    while done or pending:
+        for task in done:
+            try:
+                result = task.result()
+            except HedgeLost:
+                continue
+            except Exception as e:
+                error = e
+                continue
+            for other in pending:
+                other.cancel()  # Cancelled requests remove their own part file.
+            for other in part_paths:
+                if other is not task and other.done():
+                    await loop.run_in_executor(disk_executor, discard_part, part_paths[other])
+            return result
+        if not pending:
+            break
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    if len(part_paths) > 1:
+        await loop.run_in_executor(disk_executor, discard_part, f"{part_path}.hedge")
+    raise error
+
+def image_key(search_term, photo, url):
+    """(file name, key in the storage backend) for a new image."""
+    file_name = create_file_name(search_term, photo, url)
+    key = sharded_path(photo['id'], file_name) if STORAGE_LAYOUT == 'sharded' else file_name
+    return file_name, key.replace(os.sep, '/')
+
+def create_file_name(search_term, photo, url):
     timestamp = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-    return f"{search_term}_{timestamp}_{photo['id']}.jpg"
+    extension = os.path.splitext(url)[1] or '.jpg'  # Originals may be PNG or GIF.
+    return f"{search_term}_{timestamp}_{photo['id']}{extension}"
+
+def save_image(chunks, upload, hasher, race=None):
+    """Stream chunks into upload, holding only one chunk in memory at a time.
+
+    Returns the number of bytes written; hasher ends up covering all of them.
+    """
+    num_bytes = 0
+    for chunk in chunks:
+        if race is not None and race.won:
+            raise HedgeLost()
+        download_bandwidth.consume(len(chunk))
+        write_chunk(upload, hasher, chunk)
+        num_bytes += len(chunk)
+    return num_bytes
+
+def open_image_upload(storage, key, part_path, mode):
+    """Open the upload a response is written to, with a sha256 that already
+    covers any bytes of part_path being appended to (mode 'ab', or None when
+    the part file is already complete)."""
+    append = mode != 'wb'
+    hasher = hash_file(part_path) if append else hashlib.sha256()
+    return storage.open_upload(key, part_path, append=append), hasher
+
+def write_chunk(upload, hasher, chunk):
+    upload.write(chunk)
+    hasher.update(chunk)
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher
+
+def part_path_for(search_term, photo, url):
+    # No timestamp here, unlike create_file_name, so a rerun finds the same .part file.
+    extension = os.path.splitext(url)[1] or '.jpg'
+    return os.path.join(folder_selected, f"{search_term}_{photo['id']}{extension}.part")
+
+def part_error(status, headers):
+    if status in (200, 206, 416):
+        # start_part discarded a stale .part file; a fresh attempt will succeed.
+        return DownloadError(f"Discarded stale partial download (HTTP {status})", retryable=True)
+    return DownloadError.from_response(status, headers)
+
+def complete_download(upload, size, total, file_name, key, search_term, photo, digest):
+    """Commit a complete upload and record it in metadata and the index.
+
+    Returns False, aborting the upload, if it is incomplete; on local storage
+    that keeps the .part file for resuming. Tar shards and content-addressed
+    blobs take the complete .part file instead of a commit.
+    """
+    if total is not None and size != total:
+        upload.abort()
+        return False
+    part_path = upload.part_path
+    if part_path is not None and OUTPUT_MODE == 'tar':
+        upload.close()
+        extension = os.path.splitext(file_name)[1]
+        record = build_metadata(search_term, photo, file_name, sha256=digest, size=size)
+        folder = folder_selected
+
+        def on_finalized(shard_name):
+            write_metadata(folder, dict(record, shard=shard_name, path=f"{photo['id']}{extension}"), photo)
+            download_index_for(folder).add(photo['id'], size, file_name)
+
+        # Reserved so a later search doesn't fetch it again while its shard is open.
+        download_index_for(folder).reserve(photo['id'])
+        tar_writer_for(folder).add(photo['id'], part_path, extension, record, on_finalized)
+        discard_part(part_path)
+        if current_job is not None:
+            current_job.finished(photo['id'], size)
+        return True
+    fields = {"path": key, "sha256": digest, "size": size}
+    if part_path is not None and CONTENT_ADDRESSED_STORAGE:
+        upload.close()
+        fields["blob"] = store_blob(part_path, digest, os.path.splitext(file_name)[1])
+        image_path = os.path.join(folder_selected, key)
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        try:
+            os.link(os.path.join(folder_selected, fields["blob"]), image_path)
+        except OSError as e:
+            # The filesystem can't hardlink; the metadata still maps the name to its blob.
+            logger.debug("Could not hardlink %s: %s", file_name, e)
+    else:
+        upload.commit()
+    if part_path is not None:
+        remove_file(f"{part_path}.json")
+    save_metadata(search_term, photo, file_name, **fields)
+    record_download(photo, size, file_name)
+    return True
+
+def record_download(photo, size, file_name):
+    download_index_for(folder_selected).add(photo['id'], size, file_name)
+    if current_job is not None:
+        current_job.finished(photo['id'], size)
 
-def save_image(content, file_name):
-    if folder_selected:
-        image_path = os.path.join(folder_selected, file_name)
-        with open(image_path, "wb") as file:
-            file.write(content)
+def store_blob(part_path, digest, extension):
+    """Move part_path into the blob store unless an identical image is already there.
+
+    Returns the blob's path relative to folder_selected.
+    """
+    relative_path = os.path.join(BLOB_DIR_NAME, digest[:2], f"{digest}{extension}")
+    blob_path = os.path.join(folder_selected, relative_path)
+    with blob_lock:
+        if os.path.exists(blob_path):
+            remove_file(part_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(part_path, blob_path)
+    return relative_path
+
+def export_metadata():
+    if not folder_selected:
+        messagebox.showwarning("Folder Not Selected", "Please select a folder to save the images.")
+        return
+    num_records = export_metadata_json(folder_selected)
+    messagebox.showinfo("Metadata Exported", f"Wrote {num_records} records to metadata.json.")
+
+def apply_rate_limits():
+    try:
+        bytes_per_second = float(bandwidth_entry.get() or 0) * 1024
+        requests_per_second = float(download_rate_entry.get() or 0)
+        api_calls_per_second = float(api_rate_entry.get() or 0)
+    except ValueError:
+        messagebox.showwarning("Invalid Limit", "Rate limits must be numbers (0 for unlimited).")
+        return
+    download_bandwidth.set_rate(bytes_per_second)
+    download_requests.set_rate(requests_per_second)
+    api_requests.set_rate(api_calls_per_second)
+
+def disk_usage_text(job):
+    text = f"Written: {format_bytes(job.actual_bytes)} of {format_bytes(job.projected_bytes)} projected"
+    if job.byte_budget:
+        text += f" (budget {format_bytes(job.byte_budget)})"
+    if folder_selected and storage_for(folder_selected).uses_local_disk:
+        text += f", {format_bytes(free_disk_bytes())} free"
+    if job.paused:
+        text += " - paused, waiting for disk space"
+    return text
+
+def progress_text(job, processed, failed, num_bytes, now):
+    """Images remaining, counts, rates and ETA for the current job."""
+    started, start_processed, start_bytes = progress_samples[0]
+    elapsed = now - started
+    images_per_second = (processed - start_processed) / elapsed if elapsed else 0
+    bytes_per_second = (num_bytes - start_bytes) / elapsed if elapsed else 0
+    processed -= job.progress_start[0]
+    failed -= job.progress_start[1]
+    remaining = download_queue.unfinished_tasks
+    if not job.producer_done.is_set():
+        # Still enqueueing, so the queue doesn't hold the whole job yet.
+        remaining = max(remaining, job.num_of_images - job.skipped - processed)
+    text = (f"Images Remaining: {remaining} | {processed - failed} done, {failed} failed | "
+            f"{images_per_second:.1f} images/s, {format_bytes(bytes_per_second)}/s")
+    if images_per_second and remaining:
+        eta = int(remaining / images_per_second)
+        text += f" | ETA {eta // 60}:{eta % 60:02d}"
+    return text
 
 def check_gui_queue():
+    concurrency_label.config(text=f"Concurrency: {concurrency.limit} ({concurrency.in_flight} in flight)")
     while True:
         try:
-            _ = gui_queue.get_nowait()
+            kind, job, text = gui_queue.get_nowait()
         except Empty:
             break
-        else:
-            progress_bar['value'] += 1
-            remaining = download_queue.qsize()
-            countdown_label.config(text=f"Images Remaining: {remaining}")
-            if remaining == 0:
-                countdown_label.config(text="All images downloaded!")
-    root.after(100, check_gui_queue)
+        if job is not current_job:
+            continue  # From a search the user has since replaced.
+        if kind == 'status':
+            countdown_label.config(text=text)
+        elif kind == 'search_ended':
+            messagebox.showinfo("Search Ended", text)
+
+    # One snapshot per tick, however many images finished since the last one.
+    now = time.monotonic()
+    processed, failed, num_bytes = progress.snapshot()
+    progress_samples.append((now, processed, num_bytes))
+    while now - progress_samples[0][0] > PROGRESS_RATE_WINDOW:
+        progress_samples.popleft()
+    job = current_job
+    if job is not None:
+        disk_label.config(text=disk_usage_text(job))
+        progress_bar['value'] = processed - job.progress_start[0]
+        remaining = download_queue.unfinished_tasks
+        if job.producer_done.is_set():
+            # The search may have returned fewer photos than requested.
+            progress_bar['maximum'] = progress_bar['value'] + remaining
+        if job.drained.is_set():
+            num_requests, num_connections = (
+                total - start for total, start in zip(connection_stats(), job.connections_start))
+            reuse = 1 - num_connections / num_requests if num_requests else 0
+            status = "All images downloaded!" if job.enqueued else "No images downloaded."
+            if failed > job.progress_start[1]:
+                status = f"Done, {failed - job.progress_start[1]} images failed (see {FAILED_DOWNLOADS_NAME})."
+            if job.skipped:
+                status += f" Skipped {job.skipped} already downloaded."
+            if job.stop_reason:
+                status += f" {job.stop_reason}"
+            countdown_label.config(
+                text=f"{status} Connection reuse: {reuse:.0%} "
+                     f"({num_connections} connections for {num_requests} requests)")
+        elif job.enqueued:
+            countdown_label.config(text=progress_text(job, processed, failed, num_bytes, now))
+    root.after(PROGRESS_REFRESH_MS, check_gui_queue)
 
 # UI Setup
 license_label = ttk.Label(root, text="License:")
@@ -205,16 +1723,78 @@ folder_btn.grid(column=0, row=3, sticky=tk.W, padx=5, pady=5)
 folder_label = ttk.Label(root, text="")
 folder_label.grid(column=1, row=3, sticky=tk.W, padx=5, pady=5)
 
+engine_label = ttk.Label(root, text="Download Engine:")
+engine_label.grid(column=0, row=4, sticky=tk.W, padx=5, pady=5)
+
+engine_menu = ttk.Combobox(root, textvariable=selected_engine, values=download_engines, state='readonly')
+engine_menu.grid(column=1, row=4, sticky=tk.W, padx=5, pady=5)
+
+hedge_check = ttk.Checkbutton(root, text="Hedge slow downloads", variable=hedge_requests)
+hedge_check.grid(column=1, row=5, sticky=tk.W, padx=5, pady=5)
+
+bandwidth_label = ttk.Label(root, text="Max KB/s (0 = unlimited):")
+bandwidth_label.grid(column=0, row=6, sticky=tk.W, padx=5, pady=5)
+
+bandwidth_entry = ttk.Entry(root, width=40)
+bandwidth_entry.insert(0, str(DOWNLOAD_BYTES_PER_SECOND // 1024))
+bandwidth_entry.grid(column=1, row=6, sticky=tk.W, padx=5, pady=5)
+
+download_rate_label = ttk.Label(root, text="Max Downloads/s:")
+download_rate_label.grid(column=0, row=7, sticky=tk.W, padx=5, pady=5)
+
+download_rate_entry = ttk.Entry(root, width=40)
+download_rate_entry.insert(0, str(DOWNLOAD_REQUESTS_PER_SECOND))
+download_rate_entry.grid(column=1, row=7, sticky=tk.W, padx=5, pady=5)
+
+api_rate_label = ttk.Label(root, text="Max API Calls/s:")
+api_rate_label.grid(column=0, row=8, sticky=tk.W, padx=5, pady=5)
+
+api_rate_entry = ttk.Entry(root, width=40)
+api_rate_entry.insert(0, str(API_REQUESTS_PER_SECOND))
+api_rate_entry.grid(column=1, row=8, sticky=tk.W, padx=5, pady=5)
+
+budget_label = ttk.Label(root, text="Max MB per job (0 = unlimited):")
+budget_label.grid(column=0, row=9, sticky=tk.W, padx=5, pady=5)
+
+budget_entry = ttk.Entry(root, width=40)
+budget_entry.insert(0, str(JOB_BYTE_BUDGET // (1024 * 1024)))
+budget_entry.grid(column=1, row=9, sticky=tk.W, padx=5, pady=5)
+
+limits_btn = ttk.Button(root, text="Apply Limits", command=apply_rate_limits)
+limits_btn.grid(column=1, row=10, sticky=tk.W, padx=5, pady=5)
+
 download_btn = ttk.Button(root, text="Download", command=download_images_from_flickr)
-download_btn.grid(column=0, row=4, columnspan=2, padx=5, pady=20)
+download_btn.grid(column=0, row=11, columnspan=2, padx=5, pady=20)
+
+export_btn = ttk.Button(root, text="Export metadata.json", command=export_metadata)
+export_btn.grid(column=0, row=10, sticky=tk.W, padx=5, pady=5)
 
 progress_bar = ttk.Progressbar(root, orient='horizontal', length=300, mode='determinate')
-progress_bar.grid(column=0, row=5, columnspan=2, sticky=tk.W+tk.E, padx=5, pady=5)
+progress_bar.grid(column=0, row=12, columnspan=2, sticky=tk.W+tk.E, padx=5, pady=5)
 
 countdown_label = ttk.Label(root, text="")
-countdown_label.grid(column=0, row=6, columnspan=2, sticky=tk.W, padx=5, pady=5)
+countdown_label.grid(column=0, row=13, columnspan=2, sticky=tk.W, padx=5, pady=5)
 
+concurrency_label = ttk.Label(root, text="")
+concurrency_label.grid(column=0, row=14, columnspan=2, sticky=tk.W, padx=5, pady=5)
 
-root.after(100, check_gui_queue)
+disk_label = ttk.Label(root, text="")
+disk_label.grid(column=0, row=15, columnspan=2, sticky=tk.W, padx=5, pady=5)
+
+
+root.after(PROGRESS_REFRESH_MS, check_gui_queue)
+root.protocol("WM_DELETE_WINDOW", close_app)
 
 root.mainloop()
+
+discard_queued_downloads()
+stop_download_engine(wait=False)
+executor.shutdown(wait=True)
+if async_engine_thread is not None:
+    async_engine_thread.join()
+hedge_executor.shutdown(wait=True)
+disk_executor.shutdown(wait=True)
+finish_tar_shards()  # Before the metadata goes, since finishing a shard records its photos.
+enrich_executor.shutdown(wait=True)
+upload_pool.shutdown(wait=True)
+metadata_writer.close()
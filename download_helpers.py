@@ -0,0 +1,395 @@
+"""Helpers of Image_Downloader.py that need neither Tk nor the Flickr API.
+
+Caching, rate limiting, adaptive concurrency, search planning, size selection
+and the resumable .part file rules live here so they can be imported and
+tested on their own; Image_Downloader.py wires them to its settings.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("image_downloader")
+
+# Flickr size suffixes, largest first. Each is requested as a url_<suffix> search
+# extra, which comes back with its width_<suffix>/height_<suffix> only if it exists.
+PHOTO_SIZES = ['o', 'k', 'h', 'l', 'c', 'z', 'm']
+FLICKR_RESULT_CAP = 4000  # photos.search returns nothing past this many results.
+FLICKR_EPOCH = 1075593600  # 2004-02-01, before the first upload to Flickr.
+
+CONCURRENCY_WINDOW = 2.0  # Seconds of samples behind each adjustment.
+CONCURRENCY_BASELINE_DECAY = 0.25  # Share of the gap a slower window closes on the p95 baseline.
+HEDGE_MIN_SAMPLES = 20  # Successful downloads needed before hedging kicks in.
+
+
+class ResponseCache:
+    """Parsed-JSON API responses on disk, expired after ttl seconds.
+
+    Entries are evicted least recently used first once the directory grows past
+    max_bytes; a file's mtime doubles as its last-used time.
+    """
+
+    def __init__(self, directory, ttl, max_bytes):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._total_bytes = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[1] if entry is not None else None
+
+    def get_entry(self, key):
+        """(time stored, value) for key, or None if it is missing or expired."""
+        path = self._path(key)
+        try:
+            with open(path, 'r') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['created'] > self.ttl:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['created'], entry['value']
+
+    def put(self, key, value):
+        path = self._path(key)
+        data = json.dumps({'created': time.time(), 'value': value})
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries())
+            if os.path.exists(path):
+                self._total_bytes -= os.path.getsize(path)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+            self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        for path, size, _ in sorted(self._entries(), key=lambda entry: entry[2]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._total_bytes -= size
+
+
+class TokenBucket:
+    """Token bucket rate limit shared by every thread and coroutine; a rate of 0 is unlimited.
+
+    reserve() books tokens up front and returns how long the caller has to wait
+    before using them, so a chunk bigger than the bucket just waits longer.
+    """
+
+    def __init__(self, rate, burst_seconds=1.0):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self._tokens = rate * burst_seconds
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self._tokens = min(self._tokens, rate * self.burst_seconds)
+
+    def reserve(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            if not self.rate:
+                self._updated = now
+                return 0.0
+            elapsed = now - self._updated
+            self._updated = now
+            self._tokens = min(self.rate * self.burst_seconds, self._tokens + elapsed * self.rate)
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def consume(self, amount=1):
+        delay = self.reserve(amount)
+        if delay:
+            time.sleep(delay)
+
+    async def consume_async(self, amount=1):
+        delay = self.reserve(amount)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class ConcurrencyController:
+    """AIMD limit on the number of in-flight downloads.
+
+    Every CONCURRENCY_WINDOW seconds the limit is re-evaluated from that
+    window's samples: halved on any 429 or when more than 5% of attempts
+    failed with a retryable (network, timeout or 5xx) error, cut by a quarter
+    when p95 latency doubles over the baseline, and raised by one while the
+    limit is what holds downloads back and throughput isn't falling. The
+    baseline follows new lows at once and drifts up towards slower windows,
+    so one quiet window with small images can't pin it.
+    """
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = initial
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._async_waiters = deque()  # Futures of coroutines waiting in acquire_async, oldest first.
+        self._baseline_p95 = None
+        self._last_throughput = 0.0
+        self._recent_latencies = deque(maxlen=500)
+        self._start_window(time.monotonic())
+
+    def _start_window(self, now):
+        self._window_start = now
+        self._latencies = []
+        self._bytes = 0
+        self._errors = 0
+        self._throttled = False
+        self._saturated = False
+
+    def acquire(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self._take_slot()
+
+    def _take_slot(self):
+        self.in_flight += 1
+        if self.in_flight >= self.limit:
+            self._saturated = True
+
+    async def acquire_async(self):
+        """acquire for coroutines: waits on a future that release hands a slot to."""
+        with self._condition:
+            if self.in_flight < self.limit:
+                self._take_slot()
+                return
+            self._saturated = True
+            waiter = asyncio.get_running_loop().create_future()
+            self._async_waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._condition:
+                if waiter in self._async_waiters:
+                    self._async_waiters.remove(waiter)
+                else:  # Cancelled after it was handed a slot; pass the slot on.
+                    self.in_flight -= 1
+                    self._hand_over()
+            raise
+
+    def _hand_over(self):
+        """Give free slots straight to waiting coroutines, so none has to poll."""
+        while self._async_waiters and self.in_flight < self.limit:
+            waiter = self._async_waiters.popleft()
+            self._take_slot()
+            waiter.get_loop().call_soon_threadsafe(grant_slot, waiter)
+
+    def release(self, latency, num_bytes=0, error=None):
+        with self._condition:
+            self.in_flight -= 1
+            self._latencies.append(latency)
+            self._bytes += num_bytes
+            if error is None:
+                self._recent_latencies.append(latency)
+            elif error.retryable:
+                # Only congestion counts: a 404 or a photo refused over the
+                # byte budget says nothing about how hard to push the server.
+                self._errors += 1
+                self._throttled = self._throttled or error.status == 429
+            now = time.monotonic()
+            if now - self._window_start >= CONCURRENCY_WINDOW:
+                self._adjust(now)
+            self._hand_over()
+            self._condition.notify_all()
+
+    def hedge_delay(self):
+        """Running p95 of successful download times, or None until there are enough samples."""
+        with self._condition:
+            if len(self._recent_latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            return percentile(self._recent_latencies, 0.95)
+
+    def _adjust(self, now):
+        throughput = self._bytes / (now - self._window_start)
+        p95 = percentile(self._latencies, 0.95)
+        old_limit = self.limit
+        if self._throttled or self._errors > 0.05 * len(self._latencies):
+            self.limit = max(self.minimum, self.limit // 2)
+        elif self._baseline_p95 is not None and p95 > 2 * self._baseline_p95:
+            self.limit = max(self.minimum, self.limit * 3 // 4)
+        elif self._saturated and throughput >= 0.95 * self._last_throughput:
+            self.limit = min(self.maximum, self.limit + 1)
+        if self._baseline_p95 is None or p95 < self._baseline_p95:
+            self._baseline_p95 = p95
+        else:
+            self._baseline_p95 += CONCURRENCY_BASELINE_DECAY * (p95 - self._baseline_p95)
+        self._last_throughput = throughput
+        if self.limit != old_limit:
+            logger.info("Concurrency %d -> %d (%.0f KB/s, p95 %.2fs, %d errors)",
+                        old_limit, self.limit, throughput / 1024, p95, self._errors)
+        self._start_window(now)
+
+
+def grant_slot(waiter):
+    if not waiter.done():  # A cancelled waiter already gave its slot back.
+        waiter.set_result(None)
+
+
+def plan_search_shards(count_results, num_of_images, search_kwargs):
+    """Split a search into upload-date windows that each stay under FLICKR_RESULT_CAP.
+
+    Windows are bisected newest first and planning stops as soon as the planned
+    shards hold enough results, so huge terms don't cost thousands of API calls.
+    count_results(**search_kwargs) returns the total number of results.
+    """
+    total = count_results(**search_kwargs)
+    if total <= FLICKR_RESULT_CAP or num_of_images <= FLICKR_RESULT_CAP:
+        return [search_kwargs] if total else []
+
+    shards = []
+    planned = 0
+    # Round "now" up to the hour so re-runs produce the same windows and hit the search cache.
+    windows = [(FLICKR_EPOCH, (int(time.time()) // 3600 + 1) * 3600)]
+    while windows and planned < num_of_images:
+        min_date, max_date = windows.pop()
+        shard = dict(search_kwargs, min_upload_date=min_date, max_upload_date=max_date)
+        count = count_results(**shard)
+        if count > FLICKR_RESULT_CAP and max_date > min_date:
+            middle = (min_date + max_date) // 2
+            windows.append((min_date, middle))
+            windows.append((middle + 1, max_date))
+        elif count:
+            shards.append(shard)
+            planned += count
+    return shards
+
+
+def select_photo_size(photo, max_dimension):
+    """Return (url, width, height) for the largest listed size within max_dimension.
+
+    Falls back to the smallest listed size. Sizes listed without dimensions
+    rank after every size with them, since they might be the original;
+    returns None when the search listed no sizes at all for the photo.
+    """
+    available = []
+    unknown = []
+    for size in PHOTO_SIZES:
+        url = photo.get(f"url_{size}")
+        if url:
+            width = int(photo.get(f"width_{size}") or 0)
+            height = int(photo.get(f"height_{size}") or 0)
+            (available if width and height else unknown).append((url, width, height))
+    for url, width, height in available:
+        if max(width, height) <= max_dimension:
+            return url, width, height
+    if available:
+        return available[-1]
+    return unknown[-1] if unknown else None
+
+
+def load_part_state(part_path):
+    try:
+        with open(f"{part_path}.json", 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def resume_headers(part_path, url):
+    """Return (offset, request headers) to resume an earlier partial download of url.
+
+    Only resumes when the first response gave us a validator, so If-Range makes
+    the server send the whole image again if it changed in the meantime.
+    Uploads that aren't staged locally have no part_path and never resume.
+    """
+    if part_path is None:
+        return 0, {}
+    state = load_part_state(part_path)
+    validator = state.get('etag') or state.get('last_modified')
+    if state.get('url') != url or not validator or not os.path.exists(part_path):
+        return 0, {}
+    offset = os.path.getsize(part_path)
+    if not offset:
+        return 0, {}  # The connection dropped before the first chunk; start over.
+    return offset, {'Range': f"bytes={offset}-", 'If-Range': validator}
+
+
+def start_part(part_path, url, offset, status, headers):
+    """Decide how to write a response into part_path.
+
+    Returns (file mode, expected total size) where a mode of None means the
+    part file is already complete, or None if the response can't be used.
+    part_path is None for uploads that aren't staged locally.
+    """
+    state = load_part_state(part_path) if offset else {}
+    if status == 206 and offset:
+        content_range = headers.get('Content-Range', '')
+        try:
+            start = int(content_range.split(' ')[1].split('-')[0])
+            total = int(content_range.split('/')[1])
+        except (IndexError, ValueError):
+            start, total = None, None
+        etag = headers.get('ETag')
+        if start != offset or (etag and state.get('etag') and etag != state['etag']):
+            discard_part(part_path)
+            return None
+        return 'ab', total
+    if status == 416 and offset and state.get('length') == offset:
+        return None, offset
+    if status == 200:
+        length = headers.get('Content-Length')
+        state = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'length': int(length) if length else None,
+        }
+        if part_path is not None:
+            with open(f"{part_path}.json", 'w') as file:
+                json.dump(state, file)
+        return 'wb', state['length']
+    if status in (206, 416) and part_path is not None:
+        discard_part(part_path)
+    return None
+
+
+def discard_part(part_path):
+    remove_file(part_path)
+    remove_file(f"{part_path}.json")
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
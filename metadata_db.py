@@ -0,0 +1,150 @@
+"""SQLite store for download metadata, with a command line to query and export it.
+
+Image_Downloader.py writes here instead of metadata.jsonl when METADATA_BACKEND
+is 'sqlite'. From a shell:
+
+    python metadata_db.py <folder> query --license 4 --owner 12345678@N00
+    python metadata_db.py <folder> export subset.csv --term cat
+"""
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+
+DB_NAME = 'metadata.db'
+METADATA_JSON_NAME = 'metadata.json'  # The legacy array, written by exports.
+METADATA_LOG_NAME = 'metadata.jsonl'  # Append-only log used by the 'jsonl' backend.
+
+# Record keys stored in their own columns; anything else goes into "extra" as JSON.
+COLUMNS = {
+    'id': 'photo_id',
+    'url': 'url',
+    'name': 'name',
+    'creator': 'owner',
+    'license': 'license',
+    'search_term': 'search_term',
+    'size': 'size',
+    'sha256': 'sha256',
+    'downloaded_at': 'downloaded_at',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    name TEXT PRIMARY KEY,
+    photo_id TEXT,
+    url TEXT,
+    owner TEXT,
+    license TEXT,
+    search_term TEXT,
+    size INTEGER,
+    sha256 TEXT,
+    downloaded_at TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS photos_photo_id ON photos (photo_id);
+CREATE INDEX IF NOT EXISTS photos_license ON photos (license);
+CREATE INDEX IF NOT EXISTS photos_owner ON photos (owner);
+CREATE INDEX IF NOT EXISTS photos_search_term ON photos (search_term);
+"""
+
+
+class MetadataDB:
+    """metadata.db in one download folder, in WAL mode so queries don't block writers."""
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, DB_NAME)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def insert_many(self, records):
+        """Insert a batch of metadata records in one transaction."""
+        columns = list(COLUMNS.values()) + ['extra']
+        sql = f"INSERT OR REPLACE INTO photos ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        with self._conn:
+            self._conn.executemany(sql, [self._to_row(record) for record in records])
+
+    def query(self, photo_id=None, license=None, owner=None, search_term=None, limit=None):
+        """Return the metadata records matching every given filter, oldest first."""
+        filters = {'photo_id': photo_id, 'license': license, 'owner': owner, 'search_term': search_term}
+        clauses = [f"{column} = ?" for column, value in filters.items() if value is not None]
+        params = [value for value in filters.values() if value is not None]
+        sql = "SELECT * FROM photos"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY downloaded_at"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        cursor = self._conn.execute(sql, params)
+        columns = [description[0] for description in cursor.description]
+        return [self._to_record(dict(zip(columns, row))) for row in cursor]
+
+    @staticmethod
+    def _to_row(record):
+        extra = {key: value for key, value in record.items() if key not in COLUMNS}
+        return [record.get(key) for key in COLUMNS] + [json.dumps(extra) if extra else None]
+
+    @staticmethod
+    def _to_record(row):
+        record = {key: row[column] for key, column in COLUMNS.items() if row[column] is not None}
+        if row['extra']:
+            record.update(json.loads(row['extra']))
+        return record
+
+
+def export_records(records, path):
+    """Write records to path as CSV or, for any other extension, a JSON array."""
+    if path.endswith('.csv'):
+        fieldnames = list(COLUMNS)
+        for record in records:
+            fieldnames.extend(key for key in record if key not in fieldnames)
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(path, 'w') as file:
+            json.dump(records, file, indent=4)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the metadata.db of a download folder.")
+    parser.add_argument('folder')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    query_parser = subparsers.add_parser('query', help="print matching records as JSON lines")
+    export_parser = subparsers.add_parser('export', help="write matching records to a .json or .csv file")
+    export_parser.add_argument('output')
+    for subparser in (query_parser, export_parser):
+        subparser.add_argument('--id', dest='photo_id')
+        subparser.add_argument('--license')
+        subparser.add_argument('--owner')
+        subparser.add_argument('--term', dest='search_term')
+        subparser.add_argument('--limit', type=int)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(os.path.join(args.folder, DB_NAME)):
+        parser.error(f"no {DB_NAME} in {args.folder}")
+    db = MetadataDB(args.folder)
+    try:
+        records = db.query(args.photo_id, args.license, args.owner, args.search_term, args.limit)
+    finally:
+        db.close()
+
+    if args.command == 'query':
+        for record in records:
+            print(json.dumps(record))
+    else:
+        export_records(records, args.output)
+        print(f"Exported {len(records)} records to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""Where downloaded images and the metadata log are stored.
+
+LocalStorage keeps everything in the download folder. S3Storage streams images
+straight into a bucket on any S3-compatible store (AWS, MinIO, ...) with
+multipart uploads, so nothing is staged on local disk. Both offer the same
+methods: images are written through open_upload, which returns an upload with
+write/commit/abort, and the metadata files through read/put/append.
+uses_local_disk tells callers whether free space on this machine matters.
+
+S3Storage needs boto3 (`pip install boto3`) and reads credentials the usual
+boto3 way, e.g. AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY in .env.
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 rejects smaller parts, except for the last one.
+
+
+class LocalStorage:
+    """Files under a local folder, addressed by their path relative to it."""
+
+    uses_local_disk = True
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def location(self, key):
+        return os.path.join(self.folder, key)
+
+    def read(self, key):
+        """The contents of key, or None if it doesn't exist."""
+        try:
+            with open(self.location(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self.location(key)
+        with open(f"{path}.tmp", 'wb') as file:
+            file.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def append(self, key, data):
+        with open(self.location(key), 'ab') as file:
+            file.write(data)
+
+    def read_appended(self, key):
+        """Everything appended to key so far."""
+        return self.read(key) or b''
+
+    def clear_appended(self, key):
+        open(self.location(key), 'wb').close()
+
+    def open_upload(self, key, part_path=None, append=False):
+        """Start writing key through part_path (<key>.part by default); see LocalUpload."""
+        path = self.location(key)
+        return LocalUpload(path, part_path or f"{path}.part", append)
+
+
+class LocalUpload:
+    """One file being written into LocalStorage.
+
+    Chunks go to a .part file that commit() renames into place. abort() only
+    closes it, so a later upload with append=True can resume where this one
+    stopped; close() does the same for callers that store the complete .part
+    file some other way (tar shards, content-addressed blobs).
+    """
+
+    def __init__(self, path, part_path, append=False):
+        self.path = path
+        self.part_path = part_path
+        self._file = open(part_path, 'ab' if append else 'wb')
+
+    def write(self, chunk):
+        self._file.write(chunk)
+
+    def close(self):
+        self._file.close()
+
+    def commit(self):
+        self._file.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        self._file.close()
+
+
+class UploadPool:
+    """Threads uploading multipart parts, shared by every S3Storage.
+
+    At most max_pending parts are queued or uploading at once; submit blocks
+    beyond that, which bounds the memory held in part buffers to about
+    max_pending * part size and slows downloads to what the store accepts.
+    """
+
+    def __init__(self, workers, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class S3Storage:
+    """Objects under prefix in an S3-compatible bucket.
+
+    S3 has no append, so each append() is stored as its own object under
+    <key>.d/ and read_appended() concatenates them in order.
+    """
+
+    uses_local_disk = False
+
+    def __init__(self, bucket, prefix, upload_pool, part_size, endpoint_url=None):
+        if boto3 is None:
+            raise RuntimeError("The S3 storage backend needs boto3 (pip install boto3).")
+        if not bucket:
+            raise RuntimeError("No S3 bucket configured.")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.upload_pool = upload_pool
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def location(self, key):
+        return f"s3://{self.bucket}/{self.prefix}{key}"
+
+    def read(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def append(self, key, data):
+        # Time first so a listing returns the pieces in order; the suffix keeps
+        # two processes appending in the same nanosecond apart.
+        piece = f"{key}.d/{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        self.put(piece, data)
+
+    def read_appended(self, key):
+        return b''.join(self.read(piece) or b'' for piece in self._appended_pieces(key))
+
+    def clear_appended(self, key):
+        pieces = self._appended_pieces(key)
+        for start in range(0, len(pieces), 1000):  # delete_objects takes 1000 keys at most.
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self.prefix + piece} for piece in pieces[start:start + 1000]],
+            })
+
+    def _appended_pieces(self, key):
+        paginator = self.client.get_paginator('list_objects_v2')
+        pieces = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}{key}.d/"):
+            pieces.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', []))
+        return sorted(pieces)
+
+    def open_upload(self, key, part_path=None, append=False):
+        """Start streaming an object to key; see S3Upload.
+
+        Nothing is staged locally, so part_path is unused and there is nothing
+        to resume: append must be False.
+        """
+        if append:
+            raise ValueError("S3 uploads can't be resumed.")
+        return S3Upload(self, self.prefix + key)
+
+
+class S3Upload:
+    """One object being streamed into S3Storage.
+
+    write() buffers chunks until a part is full and hands it to the upload
+    pool, so parts upload while the download continues. An object smaller than
+    one part is sent with a single PUT on commit(). Nothing is visible in the
+    bucket until commit() succeeds; abort() drops the parts already sent, and
+    so does a commit() that fails.
+    """
+
+    part_path = None  # Never staged on local disk.
+
+    def __init__(self, storage, key):
+        self._storage = storage
+        self._key = key
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []  # Futures of {'PartNumber', 'ETag'} dicts.
+
+    def write(self, chunk):
+        self._buffer += chunk
+        if len(self._buffer) >= self._storage.part_size:
+            self._send_part()
+
+    def commit(self):
+        client = self._storage.client
+        if self._upload_id is None:
+            client.put_object(Bucket=self._storage.bucket, Key=self._key, Body=bytes(self._buffer))
+            return
+        try:
+            if self._buffer:
+                self._send_part()
+            parts = [future.result() for future in self._parts]
+            client.complete_multipart_upload(Bucket=self._storage.bucket, Key=self._key,
+                                             UploadId=self._upload_id, MultipartUpload={'Parts': parts})
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        if self._upload_id is None:
+            return
+        for future in self._parts:
+            try:
+                future.result()
+            except Exception:
+                pass  # Aborting removes whatever did get uploaded.
+        self._storage.client.abort_multipart_upload(Bucket=self._storage.bucket, Key=self._key,
+                                                    UploadId=self._upload_id)
+
+    def _send_part(self):
+        if self._upload_id is None:
+            response = self._storage.client.create_multipart_upload(Bucket=self._storage.bucket, Key=self._key)
+            self._upload_id = response['UploadId']
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        self._parts.append(self._storage.upload_pool.submit(self._upload_part, len(self._parts) + 1, data))
+
+    def _upload_part(self, number, data):
+        response = self._storage.client.upload_part(Bucket=self._storage.bucket, Key=self._key,
+                                                    UploadId=self._upload_id, PartNumber=number, Body=data)
+        return {'PartNumber': number, 'ETag': response['ETag']}
@@ -0,0 +1,108 @@
+"""Sharded directory layout for very large download folders.
+
+With STORAGE_LAYOUT = 'sharded', Image_Downloader.py saves each image under
+two levels of subfolders picked from a hash of its photo id, e.g.
+3f/a2/cat_2023_08_01_12_00_00_53012345678.jpg, so no directory holds more than
+a few hundred files even at millions of images. An existing flat folder can be
+moved to that layout with:
+
+    python storage_layout.py <folder> [--dry-run]
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from metadata_db import DB_NAME, METADATA_JSON_NAME, METADATA_LOG_NAME, MetadataDB
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif'}
+
+
+def sharded_path(photo_id, file_name):
+    """Relative path of file_name in the sharded layout."""
+    digest = hashlib.md5(str(photo_id).encode('utf-8')).hexdigest()
+    return os.path.join(digest[:2], digest[2:4], file_name)
+
+
+def photo_id_from_file_name(file_name):
+    """The photo id create_file_name put at the end of file_name, or None."""
+    stem, extension = os.path.splitext(file_name)
+    photo_id = stem.rsplit('_', 1)[-1]
+    if extension.lower() not in IMAGE_EXTENSIONS or not photo_id.isdigit():
+        return None
+    return photo_id
+
+
+def migrate_folder(folder, dry_run=False):
+    """Move the images at the top of folder into the sharded layout.
+
+    Metadata records of moved images get their new "path". Returns a dict of
+    file name -> new relative path.
+    """
+    moved = {}
+    for entry in list(os.scandir(folder)):
+        photo_id = photo_id_from_file_name(entry.name) if entry.is_file() else None
+        if photo_id is None:
+            continue
+        relative_path = sharded_path(photo_id, entry.name)
+        moved[entry.name] = relative_path
+        if not dry_run:
+            target = os.path.join(folder, relative_path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(entry.path, target)
+    if moved and not dry_run:
+        update_metadata_paths(folder, moved)
+    return moved
+
+
+def update_metadata_paths(folder, moved):
+    """Point the metadata records of moved images at their new paths."""
+    def update(record):
+        if record.get('name') in moved:
+            record['path'] = moved[record['name']]
+        return record
+
+    json_path = os.path.join(folder, METADATA_JSON_NAME)
+    if os.path.exists(json_path):
+        with open(json_path, 'r') as file:
+            records = [update(record) for record in json.load(file)]
+        with open(f"{json_path}.tmp", 'w') as file:
+            json.dump(records, file, indent=4)
+        os.replace(f"{json_path}.tmp", json_path)
+
+    log_path = os.path.join(folder, METADATA_LOG_NAME)
+    if os.path.exists(log_path):
+        with open(log_path, 'r') as source, open(f"{log_path}.tmp", 'w') as target:
+            for line in source:
+                try:
+                    target.write(json.dumps(update(json.loads(line))) + '\n')
+                except ValueError:
+                    continue  # A line cut short by a crash.
+        os.replace(f"{log_path}.tmp", log_path)
+
+    if os.path.exists(os.path.join(folder, DB_NAME)):
+        db = MetadataDB(folder)
+        try:
+            records = [record for record in db.query() if record.get('name') in moved]
+            if records:
+                db.insert_many([update(record) for record in records])
+        finally:
+            db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move a flat download folder into the sharded layout.")
+    parser.add_argument('folder')
+    parser.add_argument('--dry-run', action='store_true', help="only list the moves")
+    args = parser.parse_args(argv)
+
+    moved = migrate_folder(args.folder, args.dry_run)
+    for file_name, relative_path in moved.items():
+        print(f"{file_name} -> {relative_path}")
+    print(f"{'Would move' if args.dry_run else 'Moved'} {len(moved)} images.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
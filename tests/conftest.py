@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules under test live next to Image_Downloader.py at the top of the repo.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,275 @@
+import asyncio
+import json
+import os
+import types
+
+import pytest
+
+import download_helpers
+from download_helpers import (FLICKR_RESULT_CAP, ConcurrencyController, ResponseCache, TokenBucket,
+                              plan_search_shards, resume_headers, select_photo_size, start_part)
+
+URL = 'https://live.staticflickr.com/1/2_abc_c.jpg'
+
+
+def write_part(path, data, etag='"v1"', length=10):
+    with open(path, 'wb') as file:
+        file.write(data)
+    with open(f"{path}.json", 'w') as file:
+        json.dump({'url': URL, 'etag': etag, 'last_modified': None, 'length': length}, file)
+
+
+def error(status=None, retryable=False):
+    return types.SimpleNamespace(status=status, retryable=retryable)
+
+
+class TestResume:
+    def test_first_attempt_records_the_validator(self, tmp_path):
+        part_path = str(tmp_path / 'cat_2.jpg.part')
+        assert resume_headers(part_path, URL) == (0, {})
+        assert start_part(part_path, URL, 0, 200, {'Content-Length': '10', 'ETag': '"v1"'}) == ('wb', 10)
+        with open(f"{part_path}.json") as file:
+            assert json.load(file)['etag'] == '"v1"'
+
+    def test_resume_after_a_dropped_connection(self, tmp_path):
+        part_path = str(tmp_path / 'cat_2.jpg.part')
+        write_part(part_path, b'abcd')
+        offset, headers = resume_headers(part_path, URL)
+        assert offset == 4
+        assert headers == {'Range': 'bytes=4-', 'If-Range': '"v1"'}
+        response_headers = {'Content-Range': 'bytes 4-9/10', 'ETag': '"v1"'}
+        assert start_part(part_path, URL, offset, 206, response_headers) == ('ab', 10)
+        assert os.path.exists(part_path)
+
+    def test_stale_etag_discards_the_part(self, tmp_path):
+        part_path = str(tmp_path / 'cat_2.jpg.part')
+        write_part(part_path, b'abcd')
+        response_headers = {'Content-Range': 'bytes 4-9/10', 'ETag': '"v2"'}
+        assert start_part(part_path, URL, 4, 206, response_headers) is None
+        assert not os.path.exists(part_path)
+        assert not os.path.exists(f"{part_path}.json")
+
+    def test_changed_image_is_sent_whole(self, tmp_path):
+        # If-Range didn't match, so the server answers 200 with the new image.
+        part_path = str(tmp_path / 'cat_2.jpg.part')
+        write_part(part_path, b'abcd')
+        assert start_part(part_path, URL, 4, 200, {'Content-Length': '12', 'ETag': '"v2"'}) == ('wb', 12)
+        with open(f"{part_path}.json") as file:
+            assert json.load(file)['etag'] == '"v2"'
+
+    def test_range_at_a_different_offset_discards_the_part(self, tmp_path):
+        part_path = str(tmp_path / 'cat_2.jpg.part')
+        write_part(part_path, b'abcd')
+        assert start_part(part_path, URL, 4, 206, {'Content-Range': 'bytes 0-9/10'}) is None
+        assert not os.path.exists(part_path)
+
+    def test_416_on_an_already_complete_part(self, tmp_path):
+        part_path = str(tmp_path / 'cat_2.jpg.part')
+        write_part(part_path, b'abcdefghij')
+        offset, _ = resume_headers(part_path, URL)
+        assert start_part(part_path, URL, offset, 416, {}) == (None, 10)
+        assert os.path.exists(part_path)
+
+    def test_416_on_an_incomplete_part_discards_it(self, tmp_path):
+        part_path = str(tmp_path / 'cat_2.jpg.part')
+        write_part(part_path, b'abcd')
+        assert start_part(part_path, URL, 4, 416, {}) is None
+        assert not os.path.exists(part_path)
+
+    def test_no_resume_without_a_validator_data_or_same_url(self, tmp_path):
+        part_path = str(tmp_path / 'cat_2.jpg.part')
+        write_part(part_path, b'abcd', etag=None)
+        assert resume_headers(part_path, URL) == (0, {})
+        write_part(part_path, b'')
+        assert resume_headers(part_path, URL) == (0, {})
+        write_part(part_path, b'abcd')
+        assert resume_headers(part_path, URL.replace('_c', '_z')) == (0, {})
+
+    def test_uploads_without_a_part_file(self):
+        assert resume_headers(None, URL) == (0, {})
+        assert start_part(None, URL, 0, 200, {'Content-Length': '10'}) == ('wb', 10)
+        assert start_part(None, URL, 0, 404, {}) is None
+
+
+class TestTokenBucket:
+    def test_unlimited(self):
+        bucket = TokenBucket(0)
+        assert bucket.reserve(10 ** 9) == 0.0
+
+    def test_burst_then_wait(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr(download_helpers.time, 'monotonic', lambda: now[0])
+        bucket = TokenBucket(100)
+        assert bucket.reserve(100) == 0.0  # One second of burst.
+        assert bucket.reserve(50) == pytest.approx(0.5)
+        now[0] += 1.5  # Refills the 50 borrowed plus 100.
+        assert bucket.reserve(100) == 0.0
+
+    def test_lowering_the_rate_caps_the_burst(self, monkeypatch):
+        monkeypatch.setattr(download_helpers.time, 'monotonic', lambda: 100.0)
+        bucket = TokenBucket(1000)
+        bucket.set_rate(10)
+        assert bucket.reserve(20) == pytest.approx(1.0)
+
+
+class TestConcurrencyController:
+    @pytest.fixture(autouse=True)
+    def adjust_on_every_release(self, monkeypatch):
+        monkeypatch.setattr(download_helpers, 'CONCURRENCY_WINDOW', 0)
+
+    def run(self, controller, latency=0.1, num_bytes=1000, errors=()):
+        controller.acquire()
+        controller.release(latency, num_bytes, *errors)
+
+    def test_429_halves_the_limit(self):
+        controller = ConcurrencyController(32, 2, 64)
+        self.run(controller, errors=[error(429, retryable=True)])
+        assert controller.limit == 16
+
+    def test_permanent_errors_are_not_congestion(self):
+        controller = ConcurrencyController(32, 2, 64)
+        for _ in range(10):
+            self.run(controller, errors=[error(404)])
+        assert controller.limit == 32
+
+    def test_slow_p95_cuts_by_a_quarter(self):
+        controller = ConcurrencyController(32, 2, 64)
+        self.run(controller, latency=0.1)
+        self.run(controller, latency=0.3)
+        assert controller.limit == 24
+
+    def test_saturated_limit_grows(self):
+        controller = ConcurrencyController(1, 1, 64)
+        self.run(controller)  # Taking the only slot saturates the limit.
+        assert controller.limit == 2
+
+    def test_baseline_recovers_from_a_quiet_window(self):
+        controller = ConcurrencyController(32, 2, 64)
+        self.run(controller, latency=0.01)
+        for _ in range(20):
+            self.run(controller, latency=0.5)
+        limit = controller.limit
+        self.run(controller, latency=0.5)
+        assert controller.limit >= limit  # 0.5s is the new normal, not a slowdown.
+
+    def test_limit_stays_within_bounds(self):
+        controller = ConcurrencyController(4, 2, 64)
+        for _ in range(5):
+            self.run(controller, errors=[error(503, retryable=True)])
+        assert controller.limit == 2
+
+    def test_waiting_coroutines_are_handed_slots(self):
+        async def main():
+            controller = ConcurrencyController(2, 1, 2)
+            active = peak = 0
+
+            async def download():
+                nonlocal active, peak
+                await controller.acquire_async()
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+                controller.release(0.01)
+
+            tasks = [asyncio.create_task(download()) for _ in range(10)]
+            await asyncio.sleep(0)
+            tasks[-1].cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return controller, peak
+
+        controller, peak = asyncio.run(main())
+        assert peak == 2
+        assert controller.in_flight == 0
+
+
+class TestPlanSearchShards:
+    @staticmethod
+    def counter(total, newest_share=0.5):
+        """Results over upload dates, newest_share of every window in its newer half."""
+        calls = []
+
+        def count_results(min_upload_date=None, max_upload_date=None, **kwargs):
+            calls.append((min_upload_date, max_upload_date))
+            if min_upload_date is None:
+                return total
+            count = total
+            low, high = download_helpers.FLICKR_EPOCH, max_upload_date
+            high = max(high, min_upload_date)
+            # Narrow the full range down to this window, half by half.
+            while (low, high) != (min_upload_date, max_upload_date) and high > low:
+                middle = (low + high) // 2
+                if min_upload_date > middle:
+                    low, count = middle + 1, int(count * newest_share)
+                else:
+                    high, count = middle, count - int(count * newest_share)
+            return count
+
+        return count_results, calls
+
+    def test_small_searches_are_one_shard(self):
+        count_results, calls = self.counter(100)
+        assert plan_search_shards(count_results, 10000, {'text': 'cat'}) == [{'text': 'cat'}]
+        assert len(calls) == 1
+
+    def test_nothing_found(self):
+        count_results, _ = self.counter(0)
+        assert plan_search_shards(count_results, 10, {'text': 'cat'}) == []
+
+    def test_bisection_stops_once_enough_is_planned(self):
+        count_results, calls = self.counter(1000000)
+        shards = plan_search_shards(count_results, 20000, {'text': 'cat'})
+        counts = [count_results(**shard) for shard in shards]
+        assert all(0 < count <= FLICKR_RESULT_CAP for count in counts)
+        assert sum(counts) >= 20000
+        assert len(calls) < 100  # Far fewer than bisecting the whole range down.
+        newest_first = [shard['min_upload_date'] for shard in shards]
+        assert newest_first == sorted(newest_first, reverse=True)
+
+
+class TestSelectPhotoSize:
+    def test_largest_within_the_limit(self):
+        photo = {
+            'url_o': 'o.jpg', 'width_o': '4000', 'height_o': '3000',
+            'url_c': 'c.jpg', 'width_c': '800', 'height_c': '600',
+            'url_m': 'm.jpg', 'width_m': '500', 'height_m': '375',
+        }
+        assert select_photo_size(photo, 800) == ('c.jpg', 800, 600)
+        assert select_photo_size(photo, 4000) == ('o.jpg', 4000, 3000)
+
+    def test_falls_back_to_the_smallest(self):
+        photo = {'url_k': 'k.jpg', 'width_k': '2048', 'height_k': '1536',
+                 'url_l': 'l.jpg', 'width_l': '1024', 'height_l': '768'}
+        assert select_photo_size(photo, 800) == ('l.jpg', 1024, 768)
+
+    def test_sizes_without_dimensions_rank_last(self):
+        photo = {'url_o': 'o.jpg', 'url_z': 'z.jpg', 'width_z': '640', 'height_z': '480'}
+        assert select_photo_size(photo, 800) == ('z.jpg', 640, 480)
+        assert select_photo_size({'url_o': 'o.jpg', 'url_l': 'l.jpg'}, 800) == ('l.jpg', 0, 0)
+        assert select_photo_size({}, 800) is None
+
+
+class TestResponseCache:
+    def test_round_trip_and_expiry(self, tmp_path, monkeypatch):
+        cache = ResponseCache(str(tmp_path), ttl=60, max_bytes=10 ** 6)
+        key = {'method': 'flickr.photos.search', 'text': 'cat'}
+        assert cache.get(key) is None
+        cache.put(key, {'photos': []})
+        assert cache.get(key) == {'photos': []}
+        assert cache.get(dict(key, text='dog')) is None
+        later = download_helpers.time.time() + 61
+        monkeypatch.setattr(download_helpers.time, 'time', lambda: later)
+        assert cache.get(key) is None
+
+    def test_least_recently_used_entries_are_evicted(self, tmp_path):
+        cache = ResponseCache(str(tmp_path), ttl=60, max_bytes=10 ** 6)
+        cache.put({'page': 0}, 'x' * 50)
+        cache.max_bytes = 3.5 * os.path.getsize(cache._path({'page': 0}))  # Room for three entries.
+        for i in range(3):
+            cache.put({'page': i}, 'x' * 50)
+            os.utime(cache._path({'page': i}), (1000 + i, 1000 + i))
+        cache.get({'page': 0})  # Used again, so page 1 is now the oldest.
+        cache.put({'page': 3}, 'x' * 50)
+        assert cache.get({'page': 1}) is None
+        assert cache.get({'page': 0}) is not None
+        assert cache.get({'page': 3}) is not None
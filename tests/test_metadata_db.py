@@ -0,0 +1,79 @@
+import csv
+import json
+
+import pytest
+
+from metadata_db import MetadataDB, export_records, main
+
+
+def record(photo_id, **fields):
+    return {
+        'id': photo_id,
+        'url': f"https://www.flickr.com/photos/owner/{photo_id}",
+        'name': f"cat_{photo_id}.jpg",
+        'creator': 'owner',
+        'license': '4',
+        'search_term': 'cat',
+        'downloaded_at': f"2023-08-01T12:00:{photo_id[-2:]}",
+        **fields,
+    }
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = MetadataDB(str(tmp_path))
+    db.insert_many([
+        record('10', size=100, sha256='a'),
+        record('11', creator='other', title='A cat'),
+        record('12', license='1', search_term='dog'),
+    ])
+    yield db
+    db.close()
+
+
+def test_query_filters(db):
+    assert [r['id'] for r in db.query()] == ['10', '11', '12']
+    assert [r['id'] for r in db.query(license='4')] == ['10', '11']
+    assert [r['id'] for r in db.query(owner='other')] == ['11']
+    assert [r['id'] for r in db.query(search_term='cat', license='4', limit=1)] == ['10']
+    assert db.query(photo_id='99') == []
+
+
+def test_records_round_trip_with_extra_fields(db):
+    assert db.query(photo_id='10')[0] == record('10', size=100, sha256='a')
+    assert db.query(photo_id='11')[0]['title'] == 'A cat'
+
+
+def test_insert_replaces_records_by_name(db):
+    db.insert_many([record('10', path='ab/cd/cat_10.jpg')])
+    records = db.query(photo_id='10')
+    assert len(records) == 1
+    assert records[0]['path'] == 'ab/cd/cat_10.jpg'
+
+
+def test_export_csv_and_json(db, tmp_path):
+    records = db.query()
+    export_records(records, str(tmp_path / 'out.csv'))
+    with open(tmp_path / 'out.csv', newline='') as file:
+        rows = list(csv.DictReader(file))
+    assert [row['id'] for row in rows] == ['10', '11', '12']
+    assert rows[1]['title'] == 'A cat'
+
+    export_records(records, str(tmp_path / 'out.json'))
+    with open(tmp_path / 'out.json') as file:
+        assert json.load(file) == records
+
+
+def test_cli_query_and_export(db, tmp_path, capsys):
+    assert main([str(tmp_path), 'query', '--owner', 'other']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)['id'] for line in lines] == ['11']
+
+    assert main([str(tmp_path), 'export', str(tmp_path / 'dogs.json'), '--term', 'dog']) == 0
+    with open(tmp_path / 'dogs.json') as file:
+        assert [r['id'] for r in json.load(file)] == ['12']
+
+
+def test_cli_without_database(tmp_path):
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / 'empty'), 'query'])
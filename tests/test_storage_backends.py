@@ -0,0 +1,230 @@
+import threading
+
+import pytest
+
+import storage_backends
+from storage_backends import LocalStorage, S3Storage, UploadPool
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class Body:
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+
+class Paginator:
+    def __init__(self, client):
+        self._client = client
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for key in self._client.objects if key.startswith(Prefix))
+        for start in range(0, len(keys), 2):  # Small pages so paging is exercised.
+            yield {'Contents': [{'Key': key} for key in keys[start:start + 2]]}
+        if not keys:
+            yield {}
+
+
+class FakeS3:
+    """Just enough of a boto3 S3 client to drive S3Storage."""
+
+    exceptions = type('exceptions', (), {'NoSuchKey': NoSuchKey})
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append('put_object')
+        self.objects[Key] = bytes(Body)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise NoSuchKey(Key)
+        return {'Body': Body(self.objects[Key])}
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.objects.pop(item['Key'], None)
+
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        return Paginator(self)
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls.append('create_multipart_upload')
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        assert numbers == sorted(parts)
+        assert [part['ETag'] for part in MultipartUpload['Parts']] == [f"etag-{n}" for n in numbers]
+        self.objects[Key] = b''.join(parts[number] for number in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append('abort_multipart_upload')
+        del self.uploads[UploadId]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FakeS3()
+    monkeypatch.setattr(storage_backends, 'boto3', type('boto3', (), {'client': lambda *a, **kw: client}))
+    monkeypatch.setattr(storage_backends, 'MIN_PART_SIZE', 4)
+    return client
+
+
+@pytest.fixture
+def pool():
+    pool = UploadPool(workers=2, max_pending=4)
+    yield pool
+    pool.shutdown()
+
+
+def test_small_object_is_a_single_put(client, pool):
+    upload = S3Storage('bkt', 'cats/', pool, part_size=8).open_upload('a.jpg')
+    upload.write(b'abc')
+    upload.write(b'de')
+    upload.commit()
+    assert client.objects == {'cats/a.jpg': b'abcde'}
+    assert client.calls == ['put_object']
+
+
+def test_large_object_is_assembled_from_parts(client, pool):
+    upload = S3Storage('bkt', 'cats/', pool, part_size=4).open_upload('a.jpg')
+    for chunk in (b'abc', b'defg', b'hi', b'j'):
+        upload.write(chunk)
+    assert 'cats/a.jpg' not in client.objects  # Nothing visible before commit.
+    upload.commit()
+    assert client.objects == {'cats/a.jpg': b'abcdefghij'}
+    assert client.calls == ['create_multipart_upload']
+    assert client.uploads == {}
+
+
+def test_part_size_has_a_floor(client, pool):
+    assert S3Storage('bkt', '', pool, part_size=1).part_size == 4
+
+
+def test_abort_leaves_no_object(client, pool):
+    upload = S3Storage('bkt', '', pool, part_size=4).open_upload('a.jpg')
+    upload.write(b'abcdefgh')
+    upload.write(b'ij')
+    upload.abort()
+    assert client.objects == {}
+    assert client.uploads == {}
+    assert client.calls == ['create_multipart_upload', 'abort_multipart_upload']
+
+
+def test_failed_commit_aborts(client, pool, monkeypatch):
+    def fail(**kwargs):
+        raise OSError("connection reset")
+
+    monkeypatch.setattr(client, 'complete_multipart_upload', fail)
+    upload = S3Storage('bkt', '', pool, part_size=4).open_upload('a.jpg')
+    upload.write(b'abcdefgh')
+    with pytest.raises(OSError):
+        upload.commit()
+    assert client.objects == {}
+    assert client.uploads == {}
+
+
+def test_s3_uploads_cannot_resume(client, pool):
+    storage = S3Storage('bkt', '', pool, part_size=4)
+    assert not storage.uses_local_disk
+    assert storage.open_upload('a.jpg').part_path is None
+    with pytest.raises(ValueError):
+        storage.open_upload('a.jpg', append=True)
+
+
+def test_abort_before_any_part_does_nothing(client, pool):
+    upload = S3Storage('bkt', '', pool, part_size=4).open_upload('a.jpg')
+    upload.write(b'ab')
+    upload.abort()
+    assert client.objects == {}
+    assert client.calls == []
+
+
+def test_s3_append_read_and_clear(client, pool):
+    storage = S3Storage('bkt', 'cats/', pool, part_size=4)
+    assert storage.read('metadata.json') is None
+    for line in (b'1\n', b'2\n', b'3\n'):
+        storage.append('metadata.jsonl', line)
+    assert storage.read_appended('metadata.jsonl') == b'1\n2\n3\n'
+    storage.clear_appended('metadata.jsonl')
+    assert storage.read_appended('metadata.jsonl') == b''
+
+
+def test_s3_needs_boto3_and_a_bucket(monkeypatch, pool):
+    monkeypatch.setattr(storage_backends, 'boto3', None)
+    with pytest.raises(RuntimeError):
+        S3Storage('bkt', '', pool, part_size=4)
+    monkeypatch.setattr(storage_backends, 'boto3', type('boto3', (), {'client': lambda *a, **kw: FakeS3()}))
+    with pytest.raises(RuntimeError):
+        S3Storage('', '', pool, part_size=4)
+
+
+def test_upload_pool_blocks_beyond_max_pending():
+    pool = UploadPool(workers=1, max_pending=2)
+    gate = threading.Event()
+    pool.submit(gate.wait)
+    pool.submit(gate.wait)
+    submitted = threading.Event()
+    thread = threading.Thread(target=lambda: (pool.submit(lambda: None), submitted.set()))
+    thread.start()
+    try:
+        assert not submitted.wait(0.2)
+    finally:
+        gate.set()
+    assert submitted.wait(5)
+    thread.join()
+    pool.shutdown()
+
+
+def test_local_storage(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    assert storage.read('metadata.json') is None
+    storage.put('metadata.json', b'[]')
+    assert storage.read('metadata.json') == b'[]'
+    storage.append('metadata.jsonl', b'1\n')
+    storage.append('metadata.jsonl', b'2\n')
+    assert storage.read_appended('metadata.jsonl') == b'1\n2\n'
+    storage.clear_appended('metadata.jsonl')
+    assert storage.read_appended('metadata.jsonl') == b''
+
+
+def test_local_upload_commits_through_a_part_file(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    assert storage.uses_local_disk
+    upload = storage.open_upload('ab/cd/a.jpg', str(tmp_path / 'a.jpg.part'))
+    upload.write(b'abc')
+    assert not (tmp_path / 'ab').exists()
+    upload.commit()
+    assert (tmp_path / 'ab' / 'cd' / 'a.jpg').read_bytes() == b'abc'
+    assert not (tmp_path / 'a.jpg.part').exists()
+
+
+def test_aborted_local_upload_can_be_resumed(tmp_path):
+    storage = LocalStorage(str(tmp_path))
+    upload = storage.open_upload('a.jpg')
+    upload.write(b'abc')
+    upload.abort()
+    assert (tmp_path / 'a.jpg.part').read_bytes() == b'abc'
+    assert not (tmp_path / 'a.jpg').exists()
+
+    upload = storage.open_upload('a.jpg', append=True)
+    upload.write(b'def')
+    upload.commit()
+    assert (tmp_path / 'a.jpg').read_bytes() == b'abcdef'
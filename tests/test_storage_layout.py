@@ -0,0 +1,71 @@
+import json
+import os
+
+from metadata_db import MetadataDB
+from storage_layout import main, migrate_folder, photo_id_from_file_name, sharded_path
+
+
+def make_flat_folder(folder):
+    for name in ('cat_2023_08_01_12_00_00_101.jpg', 'cat_2023_08_01_12_00_01_102.png'):
+        (folder / name).write_bytes(b'image')
+    (folder / 'notes.txt').write_text('not an image')
+    (folder / 'cat_cover.jpg').write_bytes(b'no photo id')
+    records = [{'id': '101', 'name': 'cat_2023_08_01_12_00_00_101.jpg'},
+               {'id': '102', 'name': 'cat_2023_08_01_12_00_01_102.png'}]
+    (folder / 'metadata.json').write_text(json.dumps(records[:1]))
+    (folder / 'metadata.jsonl').write_text(json.dumps(records[1]) + '\n' + '{"cut short')
+    db = MetadataDB(str(folder))
+    db.insert_many(records)
+    db.close()
+
+
+def test_sharded_path_is_stable_and_two_levels_deep():
+    path = sharded_path('101', 'cat_101.jpg')
+    assert path == sharded_path(101, 'cat_101.jpg')
+    first, second, name = path.split(os.sep)
+    assert len(first) == len(second) == 2
+    assert name == 'cat_101.jpg'
+
+
+def test_photo_id_from_file_name():
+    assert photo_id_from_file_name('cat_2023_08_01_12_00_00_101.jpg') == '101'
+    assert photo_id_from_file_name('cat_cover.jpg') is None
+    assert photo_id_from_file_name('metadata_1.json') is None
+
+
+def test_dry_run_moves_nothing(tmp_path):
+    make_flat_folder(tmp_path)
+    moved = migrate_folder(str(tmp_path), dry_run=True)
+    assert set(moved) == {'cat_2023_08_01_12_00_00_101.jpg', 'cat_2023_08_01_12_00_01_102.png'}
+    assert (tmp_path / 'cat_2023_08_01_12_00_00_101.jpg').exists()
+    assert 'path' not in json.loads((tmp_path / 'metadata.json').read_text())[0]
+
+
+def test_migrate_moves_images_and_updates_metadata(tmp_path):
+    make_flat_folder(tmp_path)
+    moved = migrate_folder(str(tmp_path))
+
+    for name, relative_path in moved.items():
+        assert not (tmp_path / name).exists()
+        assert (tmp_path / relative_path).read_bytes() == b'image'
+    assert (tmp_path / 'notes.txt').exists()
+    assert (tmp_path / 'cat_cover.jpg').exists()
+
+    json_records = json.loads((tmp_path / 'metadata.json').read_text())
+    assert json_records[0]['path'] == moved[json_records[0]['name']]
+    log_records = [json.loads(line) for line in (tmp_path / 'metadata.jsonl').read_text().splitlines()]
+    assert len(log_records) == 1  # The truncated line is dropped.
+    assert log_records[0]['path'] == moved[log_records[0]['name']]
+    db = MetadataDB(str(tmp_path))
+    try:
+        assert {r['name']: r['path'] for r in db.query()} == moved
+    finally:
+        db.close()
+
+    assert migrate_folder(str(tmp_path)) == {}  # Nothing left at the top.
+
+
+def test_cli(tmp_path, capsys):
+    make_flat_folder(tmp_path)
+    assert main([str(tmp_path), '--dry-run']) == 0
+    assert capsys.readouterr().out.splitlines()[-1] == 'Would move 2 images.'